@@ -3,7 +3,11 @@ import re
 import os
 import sys
 import sqlparse
-from utils import create_sql_connection_string
+from utils import IndexItemFactory, create_sql_connection_string
+from workload_reader import iter_workload_statements, TemplateCollapser
+from workload_replay import WorkloadReplayer
+from showplan import aggregate_missing_indexes
+from dmv_collector import MissingIndexCollector, weight_by_frequency
 
 # Make connection string a module-level variable so it can be overridden by GUI
 # Using r-string (raw string) to handle backslashes properly
@@ -14,12 +18,32 @@ conn_str = create_sql_connection_string(
 )
 current_database_name = 'MedicalStorePOS'  # Default database name, will be extracted from conn_str when changed
 
-def get_direct_recommendations(workload_file):
-    """Get index recommendations directly using SQL Server's DMVs"""
+def iter_select_templates(workload_file, collapser):
+    """Yield the first SELECT statement of each query template in the workload"""
+    for sql in iter_workload_statements(workload_file):
+        # Only consider SELECT statements (for index recommendations)
+        if not re.search(r'^\s*SELECT\s+', sql, re.IGNORECASE):
+            continue
+        query = collapser.add(sql)
+        if query is not None:
+            yield query
+
+
+def get_direct_recommendations(workload_file, workers=4, max_in_flight=None, query_timeout=0, showplan=False):
+    """Get index recommendations directly using SQL Server's DMVs
+
+    The workload is replayed over `workers` connections with at most `max_in_flight`
+    queries outstanding, each limited to `query_timeout` seconds (0 means no limit).
+    With `showplan` the queries are only compiled, and the missing indexes are read from
+    their estimated plans instead of the DMVs.
+    """
     
     # Use the module-level connection string (can be overridden by the GUI)
     global conn_str, current_database_name
-    
+
+    # Release the indexes of earlier analyses run by the same process, e.g. from the GUI.
+    IndexItemFactory().reset()
+
     try:
         # Extract the current database name from the connection string
         db_match = re.search(r'Database=([^;]+)', conn_str, re.IGNORECASE)
@@ -33,78 +57,47 @@ def get_direct_recommendations(workload_file):
         conn = pyodbc.connect(conn_str)
         cursor = conn.cursor()
         
-        # Clear existing missing index data
-        print("Clearing existing missing index data...")
-        cursor.execute(f"""
-            -- Clear the procedure cache to get a fresh start
-            DBCC FREEPROCCACHE;
-            
-            -- Clear query store data
-            ALTER DATABASE [{current_database_name}] SET QUERY_STORE CLEAR;
-        """)
+        if not showplan:
+            # Remember the missing index statistics gathered so far instead of clearing them,
+            # so that the plan cache of the other sessions on the server is left alone
+            print("Taking a snapshot of existing missing index data...")
+            collector = MissingIndexCollector(cursor)
+            collector.start()
         
-        # Load and execute each query in the workload
+        # Stream the workload and replay each query template as soon as it has been read.
+        # Statements differing only in literal values are collapsed into the frequency
+        # of the first one, which is the only one executed. Its actual plan tells which
+        # missing indexes it counted for, to weight them by the frequency afterwards.
         print("Loading workload queries...")
-        with open(workload_file, 'r', errors='ignore') as file:
-            raw_text = file.read()
-            
-            # Remove SQL comments
-            raw_text = re.sub(r'--.*?\n', '\n', raw_text)  # Remove single line comments
-            raw_text = re.sub(r'/\*[\s\S]*?\*/', '', raw_text)  # Remove multi-line comments
-            
-            # Split by semicolons to get individual queries
-            raw_queries = re.split(r';\s*', raw_text)
-            
-            queries = []
-            for sql in raw_queries:
-                sql = sql.strip()
-                if not sql:
-                    continue
-                    
-                # Only consider SELECT statements (for index recommendations)
-                if re.search(r'^\s*SELECT\s+', sql, re.IGNORECASE):
-                    queries.append(sql)
-        
-        print(f"Executing {len(queries)} queries to generate index statistics...")
-        for i, sql in enumerate(queries):
-            try:
-                print(f"Executing query {i+1}/{len(queries)}: {sql[:50]}...")
-                cursor.execute(sql)
-                
-                # Consume the results to ensure query completes fully
-                while cursor.nextset():
-                    pass
-            except Exception as e:
-                print(f"Error executing query: {e}")
-                continue
+        collapser = TemplateCollapser()
+        replayer = WorkloadReplayer(conn_str, workers=workers, max_in_flight=max_in_flight,
+                                    query_timeout=query_timeout, showplan=showplan, actual_plans=True)
+        print(f"Replaying workload with {replayer.workers} concurrent connections...")
+        executed = 0
+        planned_queries = []
+        for result in replayer.replay(iter_select_templates(workload_file, collapser)):
+            executed += 1
+            sql = result.query.get_statement()
+            if not result.succeeded:
+                print(f"Error executing query {result.position + 1}: {result.error}")
+            elif showplan:
+                planned_queries.append((result.plan, result.query))
+                print(f"Planned query {result.position + 1} with estimated cost {result.plan.cost:.2f}: "
+                      f"{sql[:50]}...")
+            else:
+                planned_queries.append((result.plan, result.query))
+                print(f"Executed query {result.position + 1} in {result.elapsed:.2f}s: {sql[:50]}...")
+        print(f"Executed {executed} query templates covering {collapser.get_statement_count()} statements "
+              f"to generate index statistics.")
         
-        # Get recommendations from missing index DMVs
-        print("\nGetting index recommendations from SQL Server DMVs...")
-        cursor.execute("""
-            SELECT 
-                OBJECT_SCHEMA_NAME(mid.object_id) AS SchemaName,
-                OBJECT_NAME(mid.object_id) AS TableName,
-                migs.avg_total_user_cost * (migs.avg_user_impact / 100.0) * (migs.user_seeks + migs.user_scans) AS Improvement,
-                migs.user_seeks + migs.user_scans AS user_events,
-                'CREATE INDEX IX_' + OBJECT_NAME(mid.object_id) + '_' 
-                    + REPLACE(REPLACE(REPLACE(ISNULL(mid.equality_columns, '') 
-                    + CASE WHEN mid.equality_columns IS NOT NULL AND mid.inequality_columns IS NOT NULL THEN '_' ELSE '' END
-                    + ISNULL(mid.inequality_columns, ''), ', ', '_'), '[', ''), ']', '') 
-                    + ' ON ' + mid.statement 
-                    + ' (' + ISNULL(mid.equality_columns, '')
-                    + CASE WHEN mid.equality_columns IS NOT NULL AND mid.inequality_columns IS NOT NULL THEN ', ' ELSE '' END 
-                    + ISNULL(mid.inequality_columns, '') + ')'
-                    + ISNULL(' INCLUDE (' + mid.included_columns + ')', '') AS CreateStatement
-            FROM sys.dm_db_missing_index_groups mig
-            INNER JOIN sys.dm_db_missing_index_group_stats migs
-                ON migs.group_handle = mig.index_group_handle
-            INNER JOIN sys.dm_db_missing_index_details mid
-                ON mig.index_handle = mid.index_handle
-            WHERE mid.database_id = DB_ID()
-            ORDER BY Improvement DESC;
-        """)
-        
-        results = cursor.fetchall()
+        if showplan:
+            # Frequencies are only final once the whole workload has been read.
+            print("\nGetting index recommendations from estimated query plans...")
+            results = aggregate_missing_indexes((plan, query.get_frequency()) for plan, query in planned_queries)
+        else:
+            print("\nGetting index recommendations from SQL Server DMVs...")
+            results = weight_by_frequency(collector.collect(),
+                                          ((plan, query.get_frequency()) for plan, query in planned_queries))
         
         print("\n" + "#" * 20 + " RECOMMENDED INDEXES " + "#" * 20)
         
@@ -192,8 +185,13 @@ def get_direct_recommendations(workload_file):
         return False
 
 if __name__ == "__main__":
+    args = sys.argv[1:]
+    # Only compile the workload and read missing indexes from the estimated plans
+    showplan = '--showplan' in args
+    if showplan:
+        args.remove('--showplan')
     workload_file = "workload.sql"
-    if len(sys.argv) > 1:
-        workload_file = sys.argv[1]
+    if len(args) > 0:
+        workload_file = args[0]
     
-    get_direct_recommendations(workload_file)
\ No newline at end of file
+    get_direct_recommendations(workload_file, showplan=showplan)
\ No newline at end of file
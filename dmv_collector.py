@@ -0,0 +1,127 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+try:
+    from .showplan import MissingIndexRecommendation, QueryPlan
+except ImportError:
+    from showplan import MissingIndexRecommendation, QueryPlan
+
+# Missing index groups are identified by their definition rather than by their handles,
+# since SQL Server may evict a group and create it again under a new handle.
+MISSING_INDEX_SNAPSHOT_SQL = """
+    SELECT
+        mid.object_id,
+        ISNULL(mid.equality_columns, '') AS equality_columns,
+        ISNULL(mid.inequality_columns, '') AS inequality_columns,
+        ISNULL(mid.included_columns, '') AS included_columns,
+        OBJECT_SCHEMA_NAME(mid.object_id) AS SchemaName,
+        OBJECT_NAME(mid.object_id) AS TableName,
+        migs.user_seeks + migs.user_scans AS user_events,
+        migs.avg_total_user_cost,
+        migs.avg_user_impact,
+        'CREATE INDEX IX_' + OBJECT_NAME(mid.object_id) + '_'
+            + REPLACE(REPLACE(REPLACE(ISNULL(mid.equality_columns, '')
+            + CASE WHEN mid.equality_columns IS NOT NULL AND mid.inequality_columns IS NOT NULL THEN '_' ELSE '' END
+            + ISNULL(mid.inequality_columns, ''), ', ', '_'), '[', ''), ']', '')
+            + ' ON ' + mid.statement
+            + ' (' + ISNULL(mid.equality_columns, '')
+            + CASE WHEN mid.equality_columns IS NOT NULL AND mid.inequality_columns IS NOT NULL THEN ', ' ELSE '' END
+            + ISNULL(mid.inequality_columns, '') + ')'
+            + ISNULL(' INCLUDE (' + mid.included_columns + ')', '') AS CreateStatement
+    FROM sys.dm_db_missing_index_groups mig
+    INNER JOIN sys.dm_db_missing_index_group_stats migs
+        ON migs.group_handle = mig.index_group_handle
+    INNER JOIN sys.dm_db_missing_index_details mid
+        ON mig.index_handle = mid.index_handle
+    WHERE mid.database_id = DB_ID();
+"""
+
+
+@dataclass
+class MissingIndexStats:
+    schema: str
+    table: str
+    create_statement: str
+    user_events: int = 0
+    # Totals rather than the averages reported by the DMV, so that snapshots can be subtracted.
+    total_user_cost: float = 0
+    total_user_impact: float = 0
+
+
+def take_missing_index_snapshot(cursor) -> Dict[Tuple, MissingIndexStats]:
+    """Read the cumulative missing index statistics of the current database."""
+    snapshot = {}
+    cursor.execute(MISSING_INDEX_SNAPSHOT_SQL)
+    for row in cursor.fetchall():
+        key = (row.object_id, row.equality_columns, row.inequality_columns, row.included_columns)
+        user_events = int(row.user_events or 0)
+        snapshot[key] = MissingIndexStats(row.SchemaName, row.TableName, row.CreateStatement, user_events,
+                                          float(row.avg_total_user_cost or 0) * user_events,
+                                          float(row.avg_user_impact or 0) * user_events)
+    return snapshot
+
+
+def diff_missing_index_snapshots(before: Dict[Tuple, MissingIndexStats],
+                                 after: Dict[Tuple, MissingIndexStats]) -> List[MissingIndexRecommendation]:
+    """Attribute to the workload only what the DMVs gained between two snapshots, and weight
+    it like the DMV query: avg cost * avg impact / 100 * (user seeks + user scans)."""
+    recommendations = []
+    for key, stats in after.items():
+        user_events = stats.user_events
+        total_user_cost = stats.total_user_cost
+        total_user_impact = stats.total_user_impact
+        previous = before.get(key)
+        # A group with fewer events than before has been evicted and recreated meanwhile,
+        # so all of its events happened after the first snapshot.
+        if previous and previous.user_events <= user_events:
+            user_events -= previous.user_events
+            total_user_cost -= previous.total_user_cost
+            total_user_impact -= previous.total_user_impact
+        if user_events <= 0:
+            continue
+        avg_user_cost = total_user_cost / user_events
+        avg_user_impact = total_user_impact / user_events
+        recommendations.append(MissingIndexRecommendation(stats.schema, stats.table,
+                                                          avg_user_cost * (avg_user_impact / 100.0) * user_events,
+                                                          user_events, stats.create_statement))
+    return sorted(recommendations, key=lambda recommendation: recommendation.Improvement, reverse=True)
+
+
+def weight_by_frequency(recommendations: List[MissingIndexRecommendation],
+                        results: Iterable[Tuple[QueryPlan, float]]) -> List[MissingIndexRecommendation]:
+    """Scale the DMV deltas of a workload replayed one statement per template by the
+    frequencies of the templates, given the (actual plan, frequency) of every template.
+
+    Each template which requested an index added one execution to its group, so the group
+    is scaled by the mean frequency of those templates. Groups requested by no replayed
+    plan, e.g. by other sessions, are left as they are.
+    """
+    templates = {}
+    frequencies = {}
+    for plan, freq in results:
+        for create_statement in set(missing_index.get_create_statement()
+                                    for missing_index, _, _ in plan.missing_indexes):
+            templates[create_statement] = templates.get(create_statement, 0) + 1
+            frequencies[create_statement] = frequencies.get(create_statement, 0) + freq
+    weighted = []
+    for recommendation in recommendations:
+        create_statement = recommendation.CreateStatement
+        factor = frequencies[create_statement] / templates[create_statement] if create_statement in templates else 1
+        weighted.append(recommendation._replace(Improvement=recommendation.Improvement * factor,
+                                                user_events=round(recommendation.user_events * factor)))
+    return sorted(weighted, key=lambda recommendation: recommendation.Improvement, reverse=True)
+
+
+class MissingIndexCollector:
+    """Collect the missing index statistics caused by a workload on a live server,
+    without flushing the plan cache or the Query Store of the other sessions."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.__before = {}
+
+    def start(self):
+        self.__before = take_missing_index_snapshot(self.cursor)
+
+    def collect(self) -> List[MissingIndexRecommendation]:
+        return diff_missing_index_snapshots(self.__before, take_missing_index_snapshot(self.cursor))
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import threading
+from abc import abstractmethod
+from contextlib import contextmanager
+from typing import List, Tuple
+
+from .common import BaseExecutor
+
+try:
+    import asyncpg
+    ASYNCPG_IMPORTED = True
+except ImportError:
+    ASYNCPG_IMPORTED = False
+
+try:
+    import aioodbc
+    AIOODBC_IMPORTED = True
+except ImportError:
+    AIOODBC_IMPORTED = False
+
+try:
+    from ..utils import create_sql_connection_string
+except (ImportError, ValueError):
+    from utils import create_sql_connection_string
+
+DEFAULT_POOL_SIZE = 4
+
+
+class AsyncExecutor(BaseExecutor):
+    """Executor which pipelines statements over a small pool of connections.
+
+    The connections live on an event loop owned by the executor and running in a
+    background thread. `execute_sqls` and `execute_batch` run their statements one
+    after another on a session connection of their own, like the other executors, so
+    session state such as hypothetical indexes carries over from one call to the next.
+    Only `execute_concurrently`, which can be awaited from any event loop, spreads its
+    statements over the pool, so they must not depend on session state.
+    """
+
+    def __init__(self, *args, pool_size=DEFAULT_POOL_SIZE):
+        super(AsyncExecutor, self).__init__(*args)
+        self.pool_size = max(1, pool_size)
+        self.__connections = []
+        self.__idle = None
+        self.__session_conn = None
+        self.__session_lock = None
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, name='async-executor', daemon=True)
+        self.__thread.start()
+        with self.session():
+            pass
+
+    @abstractmethod
+    async def _connect(self):
+        pass
+
+    @abstractmethod
+    async def _fetch(self, conn, sql) -> List[Tuple]:
+        """Execute one statement and return its result tuples, or an ('ERROR ...',) tuple."""
+        pass
+
+    @abstractmethod
+    async def _close(self, conn):
+        pass
+
+    def __run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
+    async def __open_pool(self):
+        if self.__idle is not None:
+            return
+        self.__idle = asyncio.Queue()
+        self.__session_lock = asyncio.Lock()
+        # One more connection than the pool, reserved to the statements depending on session state.
+        self.__session_conn, *self.__connections = await asyncio.gather(
+            *(self._connect() for _ in range(self.pool_size + 1)))
+        for conn in self.__connections:
+            self.__idle.put_nowait(conn)
+
+    async def __close_pool(self):
+        connections = self.__connections + ([self.__session_conn] if self.__session_conn is not None else [])
+        self.__connections, self.__idle, self.__session_conn = [], None, None
+        await asyncio.gather(*(self._close(conn) for conn in connections), return_exceptions=True)
+
+    async def __fetch_on_pool(self, sql):
+        conn = await self.__idle.get()
+        try:
+            return await self._fetch(conn, sql)
+        finally:
+            self.__idle.put_nowait(conn)
+
+    async def __execute_concurrently(self, sqls):
+        await self.__open_pool()
+        return await asyncio.gather(*(self.__fetch_on_pool(sql) for sql in sqls))
+
+    async def __execute_in_session(self, sqls):
+        await self.__open_pool()
+        async with self.__session_lock:
+            return [await self._fetch(self.__session_conn, sql) for sql in sqls]
+
+    async def execute_concurrently(self, sqls) -> List[List[Tuple]]:
+        """Execute the statements concurrently over the pool and return the results of each one, in order."""
+        future = asyncio.run_coroutine_threadsafe(self.__execute_concurrently(list(sqls)), self.__loop)
+        return await asyncio.wrap_future(future)
+
+    def execute_sqls(self, sqls) -> List[Tuple]:
+        results = []
+        for res in self.__run(self.__execute_in_session(list(sqls))):
+            results.extend(res)
+        return results
+
+    def execute_batch(self, sqls) -> List[Tuple]:
+        """Execute the statements one after another on the same connection and return the result of the last."""
+        results = self.__run(self.__execute_in_session(list(sqls)))
+        return results[-1] if results else []
+
+    def close(self):
+        if self.__loop.is_closed():
+            return
+        self.__run(self.__close_pool())
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+
+    @contextmanager
+    def session(self):
+        self.__run(self.__open_pool())
+        try:
+            yield
+        finally:
+            self.__run(self.__close_pool())
+
+
+class AsyncpgExecutor(AsyncExecutor):
+    """openGauss/PostgreSQL backend based on asyncpg."""
+
+    def __init__(self, *args, pool_size=DEFAULT_POOL_SIZE):
+        if not ASYNCPG_IMPORTED:
+            raise ImportError("asyncpg package is not installed. Please install it with 'pip install asyncpg'")
+        super(AsyncpgExecutor, self).__init__(*args, pool_size=pool_size)
+
+    async def _connect(self):
+        conn = await asyncpg.connect(host=self.host, port=self.port, user=self.user, password=self.password,
+                                     database=self.dbname,
+                                     server_settings={'application_name': 'DBMind-index-advisor'})
+        await conn.execute('set current_schema = %s' % self.get_schema())
+        return conn
+
+    async def _fetch(self, conn, sql):
+        try:
+            statement = await conn.prepare(sql)
+            if not statement.get_attributes():
+                await statement.fetch()
+                return []
+            rows = await statement.fetch()
+            # Same shape as DriverExecutor: the status message first, then the rows.
+            return [(statement.get_statusmsg(),)] + [tuple(row) for row in rows]
+        except asyncpg.PostgresError as e:
+            logging.warning('Found %s while executing SQL statement.', e)
+            return [('ERROR ' + str(e),)]
+
+    async def _close(self, conn):
+        await conn.close()
+
+
+class AioodbcExecutor(AsyncExecutor):
+    """SQL Server backend based on aioodbc."""
+
+    def __init__(self, *args, pool_size=DEFAULT_POOL_SIZE):
+        if not AIOODBC_IMPORTED:
+            raise ImportError("aioodbc package is not installed. Please install it with 'pip install aioodbc'")
+        super(AioodbcExecutor, self).__init__(*args, pool_size=pool_size)
+
+    async def _connect(self):
+        auth_type = 'sql' if self.user else 'windows'
+        dsn = create_sql_connection_string(self.host, self.dbname, auth_type, self.user or '', self.password or '')
+        return await aioodbc.connect(dsn=dsn, autocommit=True)
+
+    async def _fetch(self, conn, sql):
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql)
+                if not cursor.description:
+                    return []
+                return [tuple(row) for row in await cursor.fetchall()]
+        except Exception as e:
+            logging.warning('Found %s while executing SQL statement.', e)
+            return [('ERROR ' + str(e),)]
+
+    async def _close(self, conn):
+        await conn.close()
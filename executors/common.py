@@ -20,6 +20,11 @@ class BaseExecutor:
     def execute_sqls(self, sqls) -> List[str]:
         pass
 
+    def execute_batch(self, sqls) -> List[str]:
+        """Execute the statements in as few round-trips as possible. Results of all
+        statements but the last one may be dropped by executors which batch them."""
+        return self.execute_sqls(sqls)
+
     @abstractmethod
     def session(self):
         pass
@@ -10,7 +10,11 @@
 # EITHER EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT,
 # MERCHANTABILITY OR FIT FOR A PARTICULAR PURPOSE.
 # See the Mulan PSL v2 for more details.
+import json
+import os
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import logging
 from contextlib import contextmanager
@@ -28,6 +32,14 @@ except ImportError:
     PYODBC_IMPORTED = False
     logging.warning("Failed to import pyodbc. SQL Server support will not be available.")
 
+# Remembers which connection method worked for each host/database across runs.
+CONNECTION_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.autoindex', 'sqlserver_connections.json')
+# Login timeout in seconds for each concurrently probed connection method.
+PROBE_LOGIN_TIMEOUT = 5
+MAX_PROBE_WORKERS = 8
+# Rows fetched per round-trip when streaming the results of a statement.
+DEFAULT_ARRAYSIZE = 1000
+
 
 class DriverExecutor(BaseExecutor):
     def __init__(self, *arg):
@@ -44,14 +56,17 @@ class DriverExecutor(BaseExecutor):
                                      host=self.host,
                                      port=self.port,
                                      application_name='DBMind-index-advisor')
+        # Every statement is its own transaction, so no commit or rollback round-trip is needed.
+        self.conn.autocommit = True
         self.cur = self.conn.cursor()
+        # The schema is a session setting, so it is set once per connection rather than per batch.
+        self.cur.execute('set current_schema = %s' % self.get_schema())
 
     def __execute(self, sql):
-        if self.cur.closed:
+        if self.cur is None or self.cur.closed:
             self.__init_conn_handle()
         try:
             self.cur.execute(sql)
-            self.conn.commit()
             if self.cur.rowcount == -1:
                 return
             return [(self.cur.statusmessage,)] + self.cur.fetchall()
@@ -60,18 +75,25 @@ class DriverExecutor(BaseExecutor):
         except Exception as e:
             logging.warning('Found %s while executing SQL statement.', e)
             return [('ERROR ' + str(e),)]
-        finally:
-            self.conn.rollback()
 
     def execute_sqls(self, sqls) -> List[str]:
         results = []
-        sqls = ['set current_schema = %s' % self.get_schema()] + sqls
         for sql in sqls:
             res = self.__execute(sql)
             if res:
                 results.extend(res)
         return results
 
+    def execute_batch(self, sqls) -> List[str]:
+        """Send all the statements in a single round-trip. Only the result of the last
+        statement is returned, so the others should be set-up statements such as
+        hypothetical index creation before an EXPLAIN."""
+        sqls = [sql.strip().rstrip(';') for sql in sqls if sql.strip()]
+        if not sqls:
+            return []
+        res = self.__execute(';\n'.join(sqls))
+        return res if res else []
+
     def __close_conn(self):
         if self.conn and self.cur:
             self.cur.close()
@@ -84,6 +106,59 @@ class DriverExecutor(BaseExecutor):
         self.__close_conn()
 
 
+def get_installed_drivers():
+    try:
+        return pyodbc.drivers()
+    except pyodbc.Error:
+        return []
+
+
+def get_method_driver(method):
+    match = re.search(r'DRIVER=\{([^}]*)\}', method['conn_str'], re.IGNORECASE)
+    return match.group(1) if match else None
+
+
+def close_connection_future(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _load_connection_cache():
+    try:
+        with open(CONNECTION_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+_connection_cache = None
+
+
+def get_cached_connection_method(key):
+    """Description of the connection method which last worked for a host/database."""
+    global _connection_cache
+    if _connection_cache is None:
+        _connection_cache = _load_connection_cache()
+    return _connection_cache.get(key)
+
+
+def remember_connection_method(key, description):
+    """Remember the working method in memory and on disk. Only the method description is
+    stored, never the connection string, so no credential is written to the cache file."""
+    global _connection_cache
+    if _connection_cache is None:
+        _connection_cache = _load_connection_cache()
+    _connection_cache[key] = description
+    try:
+        os.makedirs(os.path.dirname(CONNECTION_CACHE_FILE), exist_ok=True)
+        tmp_file = CONNECTION_CACHE_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(_connection_cache, f, indent=2)
+        os.replace(tmp_file, CONNECTION_CACHE_FILE)
+    except OSError as e:
+        logging.warning('Failed to save the connection cache: %s', e)
+
+
 class SQLServerExecutor(BaseExecutor):
     """SQLServer executor implementation."""
 
@@ -93,6 +168,9 @@ class SQLServerExecutor(BaseExecutor):
         if not PYODBC_IMPORTED:
             raise ImportError("pyodbc package is not installed. Please install it with 'pip install pyodbc'")
         self.conn = None
+        self.__cursor = None
+        # The connection method which succeeded, to open further connections with.
+        self.__method = None
         
         # Try different SQL Server driver names (in order of preference)
         self.drivers = [
@@ -125,8 +203,8 @@ class SQLServerExecutor(BaseExecutor):
         # Connect immediately during initialization
         self.connect()
 
-    def connect(self):
-        """Connect to SQLServer."""
+    def __get_connection_methods(self):
+        """Candidate connection methods in order of preference, restricted to the installed ODBC drivers."""
         # SQL Server connection methods to try
         connection_methods = []
         
@@ -193,38 +271,84 @@ class SQLServerExecutor(BaseExecutor):
         
         # Rest of the connection methods
         # ... existing code ...
-        
-        # Try all connection methods
-        for method in connection_methods:
+
+        installed_drivers = set(get_installed_drivers())
+        if not installed_drivers:
+            return connection_methods
+        return [method for method in connection_methods
+                if get_method_driver(method) is None or get_method_driver(method) in installed_drivers]
+
+    def __get_cache_key(self):
+        return f'{self.instance_name}/{self.dbname}'
+
+    def __open(self, method, timeout=0):
+        conn = pyodbc.connect(method['conn_str'], timeout=timeout)
+        conn.autocommit = True
+        return conn
+
+    def __probe(self, connection_methods):
+        """Try the connection methods concurrently with a short login timeout and
+        return the connection and method of the most preferred one which succeeded."""
+        if not connection_methods:
+            return None, None
+        executor = ThreadPoolExecutor(max_workers=min(len(connection_methods), MAX_PROBE_WORKERS))
+        futures = [executor.submit(self.__open, method, PROBE_LOGIN_TIMEOUT) for method in connection_methods]
+        chosen_conn, chosen_method = None, None
+        for method, future in zip(connection_methods, futures):
+            if chosen_conn is not None:
+                # Close the less preferred connections as soon as they are established.
+                future.add_done_callback(close_connection_future)
+                continue
             try:
-                print(f"Trying: {method['description']}")
-                conn_str = method.get('conn_str', '')
-                self.conn = pyodbc.connect(conn_str)
-                self.conn.autocommit = True
+                chosen_conn, chosen_method = future.result(), method
                 print(f"✓ CONNECTION SUCCESSFUL: {method['description']}")
-                
-                # Log driver and connection version info
+            except pyodbc.Error as e:
+                print(f"  × {method['description']} failed: {str(e)[:100]}")
+            except Exception as e:
+                print(f"  × {method['description']} unexpected error: {str(e)[:100]}")
+        # Do not wait for the slower probes to log in or time out, their callbacks close them.
+        executor.shutdown(wait=False, cancel_futures=True)
+        return chosen_conn, chosen_method
+
+    def connect(self):
+        """Connect to SQLServer."""
+        connection_methods = self.__get_connection_methods()
+        cache_key = self.__get_cache_key()
+
+        # Reconnect with the method which worked last time in a single attempt.
+        cached_description = get_cached_connection_method(cache_key)
+        cached_methods = [method for method in connection_methods if method['description'] == cached_description]
+        if cached_methods:
+            try:
+                self.conn = self.__open(cached_methods[0], PROBE_LOGIN_TIMEOUT)
+                self.__method = cached_methods[0]
+                print(f"✓ CONNECTION SUCCESSFUL: {cached_description}")
+                return True
+            except pyodbc.Error as e:
+                print(f"  × Cached connection method failed: {str(e)[:100]}")
+
+        # Otherwise probe the other candidates, skipping duplicated connection strings.
+        probed_conn_strs = set(method['conn_str'] for method in cached_methods)
+        candidates = []
+        for method in connection_methods:
+            if method['conn_str'] not in probed_conn_strs:
+                probed_conn_strs.add(method['conn_str'])
+                candidates.append(method)
+        print(f"Probing {len(candidates)} connection methods...")
+        conn, method = self.__probe(candidates)
+        if conn is not None:
+            self.conn = conn
+            self.__method = method
+            remember_connection_method(cache_key, method['description'])
+            try:
                 cursor = self.conn.cursor()
-                cursor.execute("SELECT @@VERSION")
-                version = cursor.fetchone()[0]
+                cursor.execute("SELECT @@VERSION, DB_NAME()")
+                version, db_name = cursor.fetchone()
                 print(f"SQL Server Version: {version[:50]}...")
-                
-                # Test if the database exists and can be accessed
-                try:
-                    cursor.execute(f"USE {self.dbname}")
-                    cursor.execute("SELECT DB_NAME()")
-                    db_name = cursor.fetchone()[0]
-                    print(f"Connected to database: {db_name}")
-                except pyodbc.Error as e:
-                    print(f"Warning: Database '{self.dbname}' may not exist or is not accessible: {str(e)}")
-                
-                return True
+                print(f"Connected to database: {db_name}")
             except pyodbc.Error as e:
-                print(f"  × Connection failed: {str(e)[:100]}")
-                continue
-            except Exception as e:
-                print(f"  × Unexpected error: {str(e)[:100]}")
-                continue
+                print(f"Warning: Database '{self.dbname}' may not exist or is not accessible: {str(e)}")
+            return True
 
         # Display detailed error information
         print("\n=== SQL SERVER CONNECTION TROUBLESHOOTING ===")
@@ -251,32 +375,127 @@ class SQLServerExecutor(BaseExecutor):
         
         return False
 
-    def execute_sql(self, sql):
-        """Execute SQL in SQLServer."""
-        if self.conn is None:
-            if not self.connect():
-                error_msg = "Cannot execute SQL: No connection to SQL Server"
-                print(error_msg)
-                logging.error(error_msg)
-                return []
-        
+    def __ensure_connection(self):
+        if self.conn is None and not self.connect():
+            error_msg = "Cannot execute SQL: No connection to SQL Server"
+            print(error_msg)
+            logging.error(error_msg)
+            return False
+        return True
+
+    def __get_cursor(self):
+        """The cursor shared by all statements of the connection. Statements with
+        parameters are prepared on it, so SQL Server reuses their plans."""
+        if self.__cursor is None:
+            self.__cursor = self.conn.cursor()
+        return self.__cursor
+
+    def __reset_cursor(self):
+        # A failed statement may leave pending results behind, so start afresh.
+        if self.__cursor is not None:
+            try:
+                self.__cursor.close()
+            except pyodbc.Error:
+                pass
+            self.__cursor = None
+
+    def __report_error(self, sql, e):
+        if isinstance(e, pyodbc.Error):
+            error_msg = f"Failed to execute SQL: {sql}, error: {e}"
+        else:
+            error_msg = f"Unexpected error executing SQL: {e}"
+        print(error_msg)
+        logging.error(error_msg)
+        self.__reset_cursor()
+
+    def execute_sql(self, sql, params=None):
+        """Execute SQL in SQLServer. `params` fill the '?' markers of a parameterized statement."""
+        if not self.__ensure_connection():
+            return []
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(sql)
+            cursor = self.__get_cursor()
+            if params is None:
+                cursor.execute(sql)
+            else:
+                cursor.execute(sql, params)
             if cursor.description:
-                results = cursor.fetchall()
-                return results
+                return cursor.fetchall()
             return []
+        except Exception as e:
+            self.__report_error(sql, e)
+            return []
+
+    def execute_scalar(self, sql, params=None):
+        """Return the first column of the first row only, e.g. a cost, without fetching the rest."""
+        if not self.__ensure_connection():
+            return None
+        try:
+            cursor = self.__get_cursor()
+            if params is None:
+                cursor.execute(sql)
+            else:
+                cursor.execute(sql, params)
+            row = cursor.fetchone() if cursor.description else None
+            # Discard the remaining rows and result sets so the cursor can be reused.
+            while cursor.nextset():
+                pass
+            return row[0] if row else None
+        except Exception as e:
+            self.__report_error(sql, e)
+            return None
+
+    def execute_many(self, sql, seq_of_params, fast=True):
+        """Execute one parameterized statement for every set of parameters. With `fast`
+        the parameters are sent to the server in bulk rather than one round-trip each."""
+        if not self.__ensure_connection():
+            return False
+        try:
+            cursor = self.__get_cursor()
+            cursor.fast_executemany = fast
+            try:
+                cursor.executemany(sql, seq_of_params)
+            finally:
+                cursor.fast_executemany = False
+            return True
+        except Exception as e:
+            self.__report_error(sql, e)
+            return False
+
+    def iter_sql(self, sql, params=None, arraysize=DEFAULT_ARRAYSIZE):
+        """Yield the rows of a statement `arraysize` at a time, so large catalog reads
+        do not need to fit in memory. Without MARS a SQL Server connection is busy until
+        all its results are read, so the rows are read on a connection of their own and
+        other statements may be executed on the executor while iterating."""
+        if not self.__ensure_connection():
+            return
+        try:
+            conn = self.__open(self.__method)
         except pyodbc.Error as e:
-            error_msg = f"Failed to execute SQL: {sql}, error: {e}"
+            error_msg = f"Failed to open a connection for SQL: {sql}, error: {e}"
             print(error_msg)
             logging.error(error_msg)
-            return []
-        except Exception as e:
-            error_msg = f"Unexpected error executing SQL: {e}"
+            return
+        cursor = conn.cursor()
+        cursor.arraysize = arraysize
+        try:
+            if params is None:
+                cursor.execute(sql)
+            else:
+                cursor.execute(sql, params)
+            if not cursor.description:
+                return
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
+                yield from rows
+        except pyodbc.Error as e:
+            error_msg = f"Failed to execute SQL: {sql}, error: {e}"
             print(error_msg)
             logging.error(error_msg)
-            return []
+        finally:
+            cursor.close()
+            conn.close()
 
     def execute_sqls(self, sqls):
         """Execute SQLs in SQLServer."""
@@ -298,6 +517,7 @@ class SQLServerExecutor(BaseExecutor):
 
     def close(self):
         """Close the connection."""
+        self.__reset_cursor()
         if self.conn:
             self.conn.close()
             self.conn = None
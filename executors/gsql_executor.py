@@ -1,138 +1,244 @@
 
 import os
+import queue
 import shlex
 import subprocess
 import sys
+import threading
 import time
+import uuid
 from contextlib import contextmanager
-from typing import List, Tuple
+from typing import Iterator, Tuple
 import re
-import tempfile
 
 from .common import BaseExecutor
 
 BLANK = ' '
+BATCH_SENTINEL_PREFIX = '__gsql_batch_end_'
+PROCESS_EXIT_TIMEOUT = 5
+# Seconds to wait for the next output line of a batch before the process is assumed stuck,
+# e.g. on an unterminated quote which swallows the sentinel, and restarted.
+OUTPUT_TIMEOUT = 300
 
 
-def to_tuples(text):
-    """Parse execution result by using gsql
-     and convert to tuples."""
-    lines = text.splitlines()
-    separator_location = -1
-    for i, line in enumerate(lines):
-        # Find separator line such as '-----+-----+------'.
-        if re.match(r'^\s*?[-|+]+\s*$', line):
-            separator_location = i
-            break
+SEPARATOR_PATTERN = re.compile(r'^\s*?[-|+]+\s*$')
+ROWS_FOOTER_PATTERN = re.compile(r'\(\d+ rows?\)')
 
-    if separator_location < 0:
-        return []
 
-    separator = lines[separator_location]
-    left = 0
-    right = len(separator)
-    locations = list()
-    while left < right:
-        try:
-            location = separator.index('+', left, right)
-        except ValueError:
+def _strip_pieces(pieces, chars):
+    """Strip `chars` from both ends of ''.join(pieces) without joining them."""
+    while pieces:
+        piece = pieces[-1].rstrip(chars)
+        if piece:
+            pieces[-1] = piece
+            break
+        pieces.pop()
+    while pieces:
+        piece = pieces[0].lstrip(chars)
+        if piece:
+            pieces[0] = piece
             break
-        locations.append(location)
-        left = location + 1
-    # Record each value start location and end location.
-    pairs = list(zip([0] + locations, locations + [right]))
-    tuples = []
-    row = []
-    wrap_flag = False
-    # Continue to parse each line.
-    for line in lines[separator_location + 1:]:
+        pieces.pop(0)
+
+
+class TableParser:
+    """Parse the rows of a gsql table from the lines following its separator line.
+
+    Column offsets are computed once from the separator such as '-----+-----+------'.
+    A value wrapped over several lines is collected as a list of pieces and joined once.
+    """
+
+    def __init__(self, separator):
+        self.width = len(separator)
+        locations = [i for i, char in enumerate(separator) if char == '+']
+        # Increase 1 to start index to go over vertical bar (|).
+        self.slices = [(start + 1, end) for start, end in zip([0] + locations, locations + [self.width])]
+        self.__row = None
+        self.__pieces = None
+
+    def feed(self, line):
+        """Consume a line and return the tuple it completes, if any."""
         # Prevent from parsing bottom lines.
-        if len(line.strip()) == 0 or re.match(r'\(\d+ rows?\)', line):
-            continue
-        # Parse a record to tuple.
-        if wrap_flag:
-            row[-1] += line[pairs[-1][0] + 1: pairs[-1][1]].strip()
+        if not line.strip() or ROWS_FOOTER_PATTERN.match(line):
+            return None
+        if self.__row is None:
+            self.__row = [line[start:end].strip() for start, end in self.slices]
+            self.__pieces = [self.__row.pop()]
         else:
-            for start, end in pairs:
-                # Increase 1 to start index to go over vertical bar (|).
-                row.append(line[start + 1: end].strip())
+            start, end = self.slices[-1]
+            self.__pieces.append(line[start:end].strip())
+
+        if len(line) == self.width and line.endswith('+'):
+            _strip_pieces(self.__pieces, '+')
+            _strip_pieces(self.__pieces, BLANK)
+            self.__pieces.append(BLANK)
+            return None
+        self.__row.append(''.join(self.__pieces))
+        row, self.__row, self.__pieces = tuple(self.__row), None, None
+        return row
+
+
+def iter_tuples(lines):
+    """Parse the table in gsql output lines and yield its rows as tuples."""
+    parser = None
+    for line in lines:
+        if parser is not None:
+            row = parser.feed(line)
+            if row is not None:
+                yield row
+        elif SEPARATOR_PATTERN.match(line):
+            parser = TableParser(line)
 
-        if len(line) == right and re.match(r'.*\s*\+$', line):
-            wrap_flag = True
-            row[-1] = row[-1].strip('+').strip(BLANK) + BLANK
-        else:
-            tuples.append(tuple(row))
-            row = []
-            wrap_flag = False
-    return tuples
+
+def to_tuples(text):
+    """Parse execution result by using gsql
+     and convert to tuples."""
+    return list(iter_tuples(text.splitlines()))
 
 
 class GsqlExecutor(BaseExecutor):
-    def __init__(self, *args):
+    """Executor talking to one long-lived gsql process.
+
+    Statements are written to the process stdin, each batch followed by an `\\echo`
+    of a unique sentinel, so the output of the batch is known to end at that line.
+    The connection, login and session schema therefore survive between calls.
+    """
+
+    def __init__(self, *args, output_timeout=OUTPUT_TIMEOUT):
         super(GsqlExecutor, self).__init__(*args)
         self.base_cmd = ''
+        self.output_timeout = output_timeout
+        self.__command = []
+        self.__process = None
+        self.__lines = None
+        self.__lock = threading.Lock()
         with self.session():
             self.__check_connect()
 
     def __init_conn_handle(self):
-        self.base_cmd = 'gsql -p ' + str(self.port) + ' -d ' + self.dbname
+        self.__command = ['gsql', '-p', str(self.port), '-d', self.dbname]
         if self.host:
-            self.base_cmd += ' -h ' + self.host
+            self.__command += ['-h', self.host]
         if self.user:
-            self.base_cmd += ' -U ' + self.user
+            self.__command += ['-U', self.user]
         if self.password:
-            self.base_cmd += ' -W ' + shlex.quote(self.password)
+            self.__command += ['-W', self.password]
+        self.base_cmd = ' '.join(shlex.quote(arg) for arg in self.__command)
+
+    def __start_process(self):
+        self.__process = subprocess.Popen(self.__command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT, universal_newlines=True,
+                                          errors='ignore', bufsize=1)
+        # Lines are read by a thread of their own, so waiting for them can time out.
+        self.__lines = queue.Queue()
+        threading.Thread(target=self.__read, args=(self.__process.stdout, self.__lines), daemon=True).start()
+        # The schema is a session setting, so it only needs to be set when the process starts.
+        output = []
+        try:
+            output.extend(self.__iter_output(['set current_schema = %s' % self.get_schema()]))
+        except (ConnectionError, TimeoutError):
+            self.__process = None
+            raise ConnectionError("An error occurred while connecting to the database.\n" +
+                                  "Details: " + '\n'.join(output))
+
+    def __iter_output(self, sqls):
+        """Send a batch to the gsql process and yield its output lines as they arrive."""
+        sentinel = '%s%s__' % (BATCH_SENTINEL_PREFIX, uuid.uuid4().hex)
+        payload = ''
+        for sql in sqls:
+            if not sql.strip().endswith(';'):
+                # On its own line, so that a trailing -- comment cannot swallow it.
+                sql += '\n;'
+            payload += sql + '\n'
+        payload += '\\echo %s\n' % sentinel
+        # Write from another thread, otherwise a large batch could fill the stdout pipe
+        # before we start reading it, and both processes would block.
+        writer = threading.Thread(target=self.__write, args=(payload,), daemon=True)
+        writer.start()
+        while True:
+            try:
+                line = self.__lines.get(timeout=self.output_timeout)
+            except queue.Empty:
+                self.__kill()
+                raise TimeoutError('gsql produced no output for %s seconds, restarting it.' % self.output_timeout)
+            if line is None:
+                break
+            line = line.rstrip('\n')
+            if line == sentinel:
+                writer.join()
+                return
+            yield line
+        writer.join()
+        self.__process.wait()
+        raise ConnectionError('gsql exited with code %s.' % self.__process.returncode)
+
+    @staticmethod
+    def __read(stdout, lines):
+        for line in stdout:
+            lines.put(line)
+        # End of output.
+        lines.put(None)
+
+    def __kill(self):
+        self.__process.kill()
+        self.__process.wait()
+        self.__process = None
+
+    def __write(self, payload):
+        try:
+            self.__process.stdin.write(payload)
+            self.__process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            pass
 
     def __check_connect(self):
-        cmd = self.base_cmd + ' -c \"'
-        cmd += 'select 1;\"'
-        proc = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        (stdout, stderr) = proc.communicate()
-        stdout, stderr = stdout.decode(errors='ignore'), stderr.decode(errors='ignore')
-        if 'gsql: FATAL:' in stderr or 'failed to connect' in stderr:
+        self.__start_process()
+        stdout = '\n'.join(self.__iter_output(['select 1']))
+        if 'gsql: FATAL:' in stdout or 'failed to connect' in stdout:
+            self.close()
             raise ConnectionError("An error occurred while connecting to the database.\n" +
-                                  "Details: " + stderr)
+                                  "Details: " + stdout)
         return stdout
 
     @staticmethod
-    def __to_tuples(sql_result: str) -> List[Tuple[str]]:
-        is_tuple = False
-        results = []
-        tmp_tuple_lines = []
-        for line in sql_result.strip().split('\n'):
-            if re.match(r'^\s*?[-|+]+\s*$', line):
-                is_tuple = True
-            elif re.match(r'\(\d+ rows?\)', line) and is_tuple:
-                is_tuple = False
-                results.extend(to_tuples('\n'.join(tmp_tuple_lines)))
-                tmp_tuple_lines = []
-            if is_tuple:
-                tmp_tuple_lines.append(line)
+    def __iter_tuples(lines) -> Iterator[Tuple[str]]:
+        """Yield table rows as tuples and any other output line as a 1-tuple."""
+        parser = None
+        for line in lines:
+            if parser is None:
+                if SEPARATOR_PATTERN.match(line):
+                    parser = TableParser(line)
+                else:
+                    yield line,
+            elif ROWS_FOOTER_PATTERN.match(line):
+                parser = None
+                yield line,
             else:
-                results.append((line,))
-
-        return results
+                row = parser.feed(line)
+                if row is not None:
+                    yield row
 
     def execute_sqls(self, sqls):
-        sqls = ['set current_schema = %s' % self.get_schema()] + sqls
-
-        file1 = tempfile.NamedTemporaryFile(mode='w+', delete=True)
-        try:
-            for sql in sqls:
-                if not sql.strip().endswith(';'):
-                    sql += ';'
-                file1.file.write(sql + '\n')
-            file1.file.flush()
-            cmd = self.base_cmd + ' -f ' + file1.name
+        with self.__lock:
+            try:
+                if self.__process is None or self.__process.poll() is not None:
+                    self.__start_process()
+                # Output lines are parsed while they are read, without buffering the whole output.
+                return list(self.__iter_tuples(self.__iter_output(sqls)))
+            except (ConnectionError, TimeoutError) as e:
+                print(e, file=sys.stderr)
+
+    def close(self):
+        if self.__process is None:
+            return
+        if self.__process.poll() is None:
             try:
-                ret = subprocess.check_output(
-                    shlex.split(cmd), stderr=subprocess.STDOUT)
-                return self.__to_tuples(ret.decode(errors='ignore'))
-            except subprocess.CalledProcessError as e:
-                print(e.output.decode(errors='ignore'), file=sys.stderr)
-        finally:
-            file1.close()
+                self.__process.stdin.write('\\q\n')
+                self.__process.stdin.flush()
+                self.__process.wait(timeout=PROCESS_EXIT_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired):
+                self.__process.kill()
+        self.__process = None
 
     @contextmanager
     def session(self):
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    from .executors.common import BaseExecutor
+    from .utils import AdvisedIndex
+    from .workload_reader import get_statement_fingerprint
+except ImportError:
+    from executors.common import BaseExecutor
+    from utils import AdvisedIndex
+    from workload_reader import get_statement_fingerprint
+
+# Changes whenever a relation of the schemas is created, dropped, grows or is analyzed again.
+SCHEMA_VERSION_SQL = "select pg_catalog.count(*), pg_catalog.max(c.oid), pg_catalog.sum(c.relpages), " \
+                     "pg_catalog.max(greatest(pg_catalog.pg_stat_get_last_analyze_time(c.oid), " \
+                     "pg_catalog.pg_stat_get_last_autoanalyze_time(c.oid)))::text " \
+                     "from pg_catalog.pg_class c join pg_catalog.pg_namespace n on n.oid = c.relnamespace " \
+                     "where n.nspname in (%s);"
+
+
+def get_schema_version(executor: BaseExecutor):
+    """A digest of the catalog state of the executor's schemas, to key cached costs with."""
+    schemas = ', '.join("'%s'" % schema.replace("'", "''") for schema in executor.get_schema().split(','))
+    rows = [_tuple for _tuple in executor.execute_sqls([SCHEMA_VERSION_SQL % schemas]) if len(_tuple) == 4]
+    return hashlib.sha1(repr(rows).encode()).hexdigest()
+
+
+def get_config_signature(indexes: Optional[Sequence[AdvisedIndex]]):
+    """Identify a configuration by the definitions of its indexes, which unlike their ids
+    are the same in every process and run. The configuration without indexes is ''."""
+    return ';'.join(sorted('%s(%s)%s' % (index.get_table(), index.get_columns(), index.get_index_type() or '')
+                           for index in indexes or ()))
+
+
+class PlanCostCache:
+    """Costs, used index names and plans of statements under index configurations, stored
+    in a SQLite file and keyed by statement template, configuration signature and schema
+    version. Statements sharing a template share the cost measured for the first of them.
+    """
+
+    def __init__(self, path, schema_version):
+        self.path = path
+        self.schema_version = schema_version
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        # Workers of a CostingScheduler may write to the same file concurrently.
+        self.__conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS plan_costs ('
+                            'template TEXT, config TEXT, version TEXT, cost REAL, index_names TEXT, plan TEXT, '
+                            'PRIMARY KEY (template, config, version))')
+        self.__conn.commit()
+        self.__fingerprints = {}
+
+    def get_fingerprint(self, statement):
+        fingerprint = self.__fingerprints.get(statement)
+        if fingerprint is None:
+            fingerprint = self.__fingerprints[statement] = get_statement_fingerprint(statement)
+        return fingerprint
+
+    def get_many(self, statements: Iterable[str], signature) -> List[Optional[Tuple[float, List[str], str]]]:
+        """The cached (cost, used index names, plan) of each statement, or None where it is unknown."""
+        results = []
+        with self.__lock:
+            for statement in statements:
+                row = self.__conn.execute('SELECT cost, index_names, plan FROM plan_costs '
+                                          'WHERE template = ? AND config = ? AND version = ?',
+                                          (self.get_fingerprint(statement), signature,
+                                           self.schema_version)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self.hits += 1
+                    results.append((row[0], json.loads(row[1]), row[2]))
+        return results
+
+    def put_many(self, entries: Iterable[Tuple[str, float, List[str], str]], signature):
+        """Store (statement, cost, used index names, plan) entries in one transaction. Entries
+        without a cost, whose plan failed or could not be parsed, are skipped, so that they
+        are explained again rather than reused."""
+        with self.__lock, self.__conn:
+            self.__conn.executemany('INSERT OR REPLACE INTO plan_costs VALUES (?, ?, ?, ?, ?, ?)',
+                                    [(self.get_fingerprint(statement), signature, self.schema_version,
+                                      cost, json.dumps(index_names), plan)
+                                     for statement, cost, index_names, plan in entries
+                                     if cost is not None and plan])
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
@@ -0,0 +1,87 @@
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+from dataclasses import dataclass, field
+from typing import Iterable, List, Tuple
+
+SHOWPLAN_NAMESPACE = {'sp': 'http://schemas.microsoft.com/sqlserver/2004/07/showplan'}
+SHOWPLAN_ON_SQL = 'SET SHOWPLAN_XML ON'
+# Executes the statements and returns their actual plan in an extra result set after each one.
+STATISTICS_XML_ON_SQL = 'SET STATISTICS XML ON'
+SHOWPLAN_COLUMN = 'Microsoft SQL Server 2005 XML Showplan'
+
+# Same fields as the rows read from the missing index DMVs, so both can be reported alike.
+MissingIndexRecommendation = namedtuple('MissingIndexRecommendation',
+                                        ['SchemaName', 'TableName', 'Improvement', 'user_events',
+                                         'CreateStatement'])
+
+
+@dataclass(frozen=True)
+class MissingIndex:
+    database: str
+    schema: str
+    table: str
+    equality_columns: Tuple[str, ...] = ()
+    inequality_columns: Tuple[str, ...] = ()
+    included_columns: Tuple[str, ...] = ()
+
+    @property
+    def statement(self):
+        return f'{self.database}.{self.schema}.{self.table}'
+
+    def get_create_statement(self):
+        """Build the statement the same way as the DMV query in dmv_collector."""
+        key_columns = self.equality_columns + self.inequality_columns
+        name = '_'.join(key_columns).replace('[', '').replace(']', '')
+        statement = f"CREATE INDEX IX_{self.table.strip('[]')}_{name} ON {self.statement} " \
+                    f"({', '.join(key_columns)})"
+        if self.included_columns:
+            statement += f" INCLUDE ({', '.join(self.included_columns)})"
+        return statement
+
+
+@dataclass
+class QueryPlan:
+    cost: float = 0
+    # Missing index, its estimated impact in percent and the cost of the statement it applies to.
+    missing_indexes: List[Tuple[MissingIndex, float, float]] = field(default_factory=list)
+
+
+def _parse_missing_index(element) -> MissingIndex:
+    columns = {'EQUALITY': [], 'INEQUALITY': [], 'INCLUDE': []}
+    for column_group in element.findall('sp:ColumnGroup', SHOWPLAN_NAMESPACE):
+        columns.setdefault(column_group.get('Usage'), []).extend(
+            column.get('Name') for column in column_group.findall('sp:Column', SHOWPLAN_NAMESPACE))
+    return MissingIndex(element.get('Database'), element.get('Schema'), element.get('Table'),
+                        tuple(columns['EQUALITY']), tuple(columns['INEQUALITY']), tuple(columns['INCLUDE']))
+
+
+def parse_showplan(plan_xml, plan=None) -> QueryPlan:
+    """Accumulate the estimated cost and missing indexes of every statement in a plan."""
+    if plan is None:
+        plan = QueryPlan()
+    root = ElementTree.fromstring(plan_xml)
+    for statement in root.iter('{%s}StmtSimple' % SHOWPLAN_NAMESPACE['sp']):
+        statement_cost = float(statement.get('StatementSubTreeCost') or 0)
+        plan.cost += statement_cost
+        for group in statement.findall('sp:QueryPlan/sp:MissingIndexes/sp:MissingIndexGroup', SHOWPLAN_NAMESPACE):
+            impact = float(group.get('Impact') or 0)
+            for element in group.findall('sp:MissingIndex', SHOWPLAN_NAMESPACE):
+                plan.missing_indexes.append((_parse_missing_index(element), impact, statement_cost))
+    return plan
+
+
+def aggregate_missing_indexes(results: Iterable[Tuple[QueryPlan, float]]) -> List[MissingIndexRecommendation]:
+    """Weight the missing indexes of (plan, frequency) pairs the way the DMVs do:
+    statement cost * impact / 100 * number of executions, summed over the queries."""
+    improvements = {}
+    user_events = {}
+    for plan, freq in results:
+        for missing_index, impact, statement_cost in plan.missing_indexes:
+            improvements[missing_index] = improvements.get(missing_index, 0) + statement_cost * impact / 100 * freq
+            user_events[missing_index] = user_events.get(missing_index, 0) + freq
+    recommendations = [MissingIndexRecommendation(missing_index.schema.strip('[]'),
+                                                  missing_index.table.strip('[]'),
+                                                  improvement, user_events[missing_index],
+                                                  missing_index.get_create_statement())
+                       for missing_index, improvement in improvements.items()]
+    return sorted(recommendations, key=lambda recommendation: recommendation.Improvement, reverse=True)
@@ -1,48 +1,191 @@
 
 
+import json
+import sqlite3
+import threading
+import weakref
+from array import array
 from dataclasses import dataclass, field
-from typing import List
-from functools import lru_cache
+from typing import Dict, List, Sequence
 
 try:
-    from .sql_generator import get_table_info_sql, get_column_info_sql
     from .executors.common import BaseExecutor
-    from .utils import IndexItemFactory
+    from .utils import IndexItemFactory, MemoCache
 except ImportError:
-    from sql_generator import get_table_info_sql, get_column_info_sql
     from executors.common import BaseExecutor
-    from utils import IndexItemFactory
+    from utils import IndexItemFactory, MemoCache
 
+TABLE_CONTEXTS_SIZE = 1 << 12
 
-@lru_cache(maxsize=None)
-def get_table_context(origin_table, executor: BaseExecutor):
-    reltuples, parttype = None, None
+
+# Bounded cache of the table contexts already loaded for each executor, released with it.
+_table_contexts = weakref.WeakKeyDictionary()
+_NOT_LOADED = object()
+# Optional TableStatsCache persisting the column statistics across runs.
+_stats_cache = None
+
+
+class TableStatsCache:
+    """Column statistics of tables stored in a SQLite file, together with the time the
+    table was last analyzed. An entry is only used while that marker is unchanged, so
+    repeated runs read pg_stats for the tables analyzed since the previous run only."""
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS table_stats ('
+                            'database TEXT, schema TEXT, tbl TEXT, marker TEXT, '
+                            'columns TEXT, n_distincts TEXT, PRIMARY KEY (database, schema, tbl))')
+        self.__conn.commit()
+
+    def get(self, database, schema, table, marker):
+        """Return the (columns, n_distincts) stored under the marker, or None."""
+        with self.__lock:
+            row = self.__conn.execute('SELECT columns, n_distincts FROM table_stats '
+                                      'WHERE database = ? AND schema = ? AND tbl = ? AND marker = ?',
+                                      (database, schema, table.lower(), marker)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put_many(self, database, entries):
+        """Store (schema, table, marker, columns, n_distincts) entries in one transaction."""
+        with self.__lock, self.__conn:
+            self.__conn.executemany('INSERT OR REPLACE INTO table_stats VALUES (?, ?, ?, ?, ?, ?)',
+                                    [(database, schema, table.lower(), marker,
+                                      json.dumps(columns), json.dumps(n_distincts))
+                                     for schema, table, marker, columns, n_distincts in entries])
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
+
+
+def set_table_stats_cache(path):
+    """Persist the column statistics to a SQLite file, or stop persisting them with None."""
+    global _stats_cache
+    if _stats_cache is not None:
+        _stats_cache.close()
+    _stats_cache = TableStatsCache(path) if path else None
+
+
+def _get_database_key(executor: BaseExecutor):
+    return f'{executor.host}:{executor.port}/{executor.dbname}'
+
+
+def _split_origin_table(origin_table, executor: BaseExecutor):
     if '.' in origin_table:
         schemas, table = origin_table.split('.')
     else:
         table = origin_table
         schemas = executor.get_schema()
-    for _schema in schemas.split(','):
-        table_info_sqls = [get_table_info_sql(table, _schema)]
-        column_info_sqls = [get_column_info_sql(table, _schema)]
-        for _tuple in executor.execute_sqls(table_info_sqls):
-            if len(_tuple) == 2:
-                reltuples, parttype = _tuple
-                reltuples = int(float(reltuples))
-        if not reltuples:
-            continue
-        is_partitioned_table = True if parttype == 'p' else False
-        columns = []
-        n_distincts = []
-        for _tuple in executor.execute_sqls(column_info_sqls):
-            if len(_tuple) != 2:
+    return schemas.split(','), table
+
+
+def _quote_literal(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+def _get_relations_filter(schema_column, table_column, schema_tables):
+    pairs = ', '.join('(%s, %s)' % (_quote_literal(schema), _quote_literal(table.lower()))
+                      for schema, table in sorted(schema_tables))
+    return f'({schema_column}, lower({table_column})) in ({pairs})'
+
+
+def _get_bulk_table_info_sql(schema_tables):
+    # The last (auto)analyze time tells whether the statistics cached on disk are still current.
+    return "select n.nspname, c.relname, c.reltuples, c.parttype, " \
+           "coalesce(greatest(pg_catalog.pg_stat_get_last_analyze_time(c.oid), " \
+           "pg_catalog.pg_stat_get_last_autoanalyze_time(c.oid))::text, '') " \
+           "from pg_catalog.pg_class c join pg_catalog.pg_namespace n on n.oid = c.relnamespace " \
+           f"where {_get_relations_filter('n.nspname', 'c.relname', schema_tables)};"
+
+
+def _get_bulk_column_info_sql(schema_tables):
+    return "select schemaname, tablename, attname, n_distinct from pg_catalog.pg_stats " \
+           f"where {_get_relations_filter('schemaname', 'tablename', schema_tables)};"
+
+
+def load_table_contexts(origin_tables, executor: BaseExecutor):
+    """Load the contexts of all the given tables with two catalog queries in total, instead
+    of two queries per table and schema, and cache them for get_table_context."""
+    contexts = _get_executor_contexts(executor)
+    loaded = {}
+    for origin_table in origin_tables:
+        table_context = contexts.get(origin_table, _NOT_LOADED)
+        if table_context is not _NOT_LOADED:
+            loaded[origin_table] = table_context
+    resolved = {origin_table: _split_origin_table(origin_table, executor) for origin_table in origin_tables
+                if origin_table not in loaded}
+    schema_tables = set((schema, table) for schemas, table in resolved.values() for schema in schemas)
+    if not schema_tables:
+        return loaded
+
+    table_infos = {}
+    for _tuple in executor.execute_sqls([_get_bulk_table_info_sql(schema_tables)]):
+        if len(_tuple) == 5:
+            schema, relname, reltuples, parttype, marker = _tuple
+            table_infos[(schema, relname.lower())] = (int(float(reltuples)), parttype, marker)
+
+    # Tables whose statistics are unchanged since they were cached do not need pg_stats.
+    database = _get_database_key(executor)
+    column_infos = {}
+    if _stats_cache is not None:
+        for (schema, table), (reltuples, _, marker) in table_infos.items():
+            cached = _stats_cache.get(database, schema, table, marker) if reltuples else None
+            if cached is not None:
+                column_infos[(schema, table)] = cached
+    stale_tables = set(key for key, (reltuples, _, _) in table_infos.items()
+                       if reltuples and key not in column_infos)
+    if stale_tables:
+        fetched_infos = {}
+        for _tuple in executor.execute_sqls([_get_bulk_column_info_sql(stale_tables)]):
+            if len(_tuple) != 4:
                 continue
-            n_distinct, column = _tuple
+            schema, tablename, column, n_distinct = _tuple
+            columns, n_distincts = fetched_infos.setdefault((schema, tablename.lower()), ([], []))
             if column not in columns:
                 columns.append(column)
                 n_distincts.append(float(n_distinct))
-        table_context = TableContext(_schema, table, int(reltuples), columns, n_distincts, is_partitioned_table)
+        column_infos.update(fetched_infos)
+        if _stats_cache is not None:
+            _stats_cache.put_many(database, [(schema, table, table_infos[(schema, table)][2], columns, n_distincts)
+                                             for (schema, table), (columns, n_distincts) in fetched_infos.items()
+                                             if (schema, table) in table_infos])
+
+    for origin_table, (schemas, table) in resolved.items():
+        table_context = None
+        # The first schema in search order where the table has rows wins.
+        for _schema in schemas:
+            reltuples, parttype, _ = table_infos.get((_schema, table.lower()), (None, None, None))
+            if not reltuples:
+                continue
+            columns, n_distincts = column_infos.get((_schema, table.lower()), ([], []))
+            table_context = TableContext(_schema, table, reltuples, list(columns), n_distincts,
+                                         parttype == 'p')
+            break
+        contexts.put(origin_table, table_context)
+        loaded[origin_table] = table_context
+    return loaded
+
+
+def _get_executor_contexts(executor: BaseExecutor) -> MemoCache:
+    contexts = _table_contexts.get(executor)
+    if contexts is None:
+        contexts = _table_contexts[executor] = MemoCache(TABLE_CONTEXTS_SIZE)
+    return contexts
+
+
+def get_table_context(origin_table, executor: BaseExecutor):
+    table_context = _get_executor_contexts(executor).get(origin_table, _NOT_LOADED)
+    if table_context is not _NOT_LOADED:
         return table_context
+    return load_table_contexts([origin_table], executor)[origin_table]
+
+
+def clear_table_contexts():
+    _table_contexts.clear()
 
 
 @dataclass(eq=False)
@@ -51,23 +194,38 @@ class TableContext:
     table: str
     reltuples: int
     columns: List = field(default_factory=lambda: [])
-    n_distincts: List = field(default_factory=lambda: [])
+    n_distincts: Sequence[float] = field(default_factory=lambda: array('d'))
     is_partitioned_table: bool = field(default=False)
+    # Lower-cased column name to its position in columns and n_distincts.
+    column_positions: Dict[str, int] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.n_distincts = array('d', self.n_distincts)
+        self.column_positions = {}
+        for position, column in enumerate(self.columns):
+            self.column_positions.setdefault(column.lower(), position)
 
-    @lru_cache(maxsize=None)
     def has_column(self, column):
-        is_same_table = True
-        if '.' in column:
-            if column.split('.')[0].upper() != self.table.split('.')[-1].upper():
-                is_same_table = False
-            column = column.split('.')[1].lower()
-        return is_same_table and column in self.columns
-
-    @lru_cache(maxsize=None)
-    def get_n_distinct(self, column):
-        column = column.split('.')[-1].lower()
-        idx = self.columns.index(column)
-        n_distinct = self.n_distincts[idx]
-        if float(n_distinct) == float(0):
+        table, _, column = column.rpartition('.')
+        if table and table.upper() != self.table.split('.')[-1].upper():
+            return False
+        return column.lower() in self.column_positions
+
+    def __get_selectivity(self, position):
+        n_distinct = self.n_distincts[position]
+        if n_distinct == 0:
             return 1
         return 1 / (-n_distinct * self.reltuples) if n_distinct < 0 else 1 / n_distinct
+
+    def __get_position(self, column):
+        position = self.column_positions.get(column.split('.')[-1].lower())
+        if position is None:
+            raise ValueError(f'{column} is not a column of {self.table}')
+        return position
+
+    def get_n_distinct(self, column):
+        return self.__get_selectivity(self.__get_position(column))
+
+    def selectivities(self, columns):
+        """Selectivities of several columns at once, in the same order, as get_n_distinct computes them."""
+        return array('d', (self.__get_selectivity(self.__get_position(column)) for column in columns))
@@ -1,14 +1,22 @@
 
 
+import atexit
+import heapq
 import re
-from collections import defaultdict
+import sqlite3
+import threading
+import time
+import weakref
+from array import array
+from collections import defaultdict, namedtuple, OrderedDict
 from enum import Enum
-from functools import lru_cache
-from typing import List, Tuple, Sequence, Any
+from functools import lru_cache, wraps
+from typing import Any, FrozenSet, List, Sequence, Tuple
 from contextlib import contextmanager
 
+import numpy as np
 import sqlparse
-from sqlparse.tokens import Name
+from sqlparse.tokens import Name, Token as TokenType
 from sqlparse.sql import Function, Parenthesis, IdentifierList
 
 COLUMN_DELIMITER = ', '
@@ -16,6 +24,13 @@ QUERY_PLAN_SUFFIX = 'QUERY PLAN'
 EXPLAIN_SUFFIX = 'EXPLAIN'
 ERROR_KEYWORD = 'ERROR'
 PREPARE_KEYWORD = 'PREPARE'
+INITIAL_INDEXES_CAPACITY = 16
+DEFAULT_MEMO_SIZE = 1 << 16
+MEMO_CACHES_ATTR = '_memo_caches'
+TOKEN_CACHE_SIZE = 1 << 14
+# Tokenizations written to the persistent token cache per transaction.
+TOKEN_CACHE_FLUSH_SIZE = 256
+_MISSING = object()
 
 
 class QueryType(Enum):
@@ -30,11 +45,76 @@ class IndexType(Enum):
     INVALID = 3
 
 
+class StatementType(Enum):
+    SELECT = 0
+    INSERT = 1
+    DELETE = 2
+    UPDATE = 3
+
+
+_IDENTIFIER_QUOTES = re.compile(r'[\[\]"`]')
+_TABLE_REFERENCE = re.compile(r'[\w$#]+(?:\.[\w$#]+)*')
+_DML_TARGET = re.compile(r'(?:(insert)\s+into|(delete)\s+from|(delete)|(update))\s+([\w$#.]+)\s')
+_DML_STATEMENT_TYPES = (StatementType.INSERT, StatementType.DELETE, StatementType.DELETE, StatementType.UPDATE)
+_TEMPLATE_TOKEN = re.compile(r"""
+    (?P<identifier>\[[^\]]*(?:\]\][^\]]*)*\]|"[^"]*(?:""[^"]*)*")
+    |(?P<string>N?'[^']*(?:''[^']*)*')
+    |(?P<hex>\b0x[0-9a-f]*\b)
+    |(?P<number>(?<![\w@#$.])(?:\d+(?:\.\d*)?|\.\d+)(?:e[-+]?\d+)?\b)
+    """, re.IGNORECASE | re.VERBOSE)
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+_PUNCTUATION_SPACING = re.compile(r'\s*([=<>!,()+\-*/%])\s*')
+PLACEHOLDER = '?'
+
+
+def _replace_literal(match):
+    if match.group('identifier'):
+        return match.group('identifier')
+    return PLACEHOLDER
+
+
+def get_statement_template(statement):
+    """Replace literals with placeholders so that statements which differ only in
+    constant values share one template, e.g. 'IN (1, 2, 3)' becomes 'in (?)'."""
+    template = _TEMPLATE_TOKEN.sub(_replace_literal, statement)
+    template = _PLACEHOLDER_LIST.sub('(' + PLACEHOLDER + ')', template)
+    template = _PUNCTUATION_SPACING.sub(r'\1', template)
+    return _WHITESPACE.sub(' ', template).strip().lower()
+
+
+def get_statement_type(statement):
+    """Return the statement type and the table it modifies, if any, of a lower-cased statement."""
+    match = _DML_TARGET.match(statement)
+    if not match:
+        return StatementType.SELECT, None
+    for group, statement_type in enumerate(_DML_STATEMENT_TYPES, 1):
+        if match.group(group):
+            return statement_type, match.group(5)
+
+
+def get_referenced_names(statement):
+    """Yield the names a table may be referenced by in a statement: every qualified
+    suffix of a dotted name ('db.public.t' gives 'db.public.t' and 'public.t') and undotted words."""
+    for reference in _TABLE_REFERENCE.findall(statement):
+        parts = reference.split('.')
+        if len(parts) == 1:
+            yield reference
+        for i in range(len(parts) - 1):
+            yield '.'.join(parts[i:])
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
 def replace_function_comma(statement):
     """Replace the ? in function to the corresponding value to ensure that prepare execution can be executed properly"""
+    if '?' not in get_placeholders(statement):
+        # Same text as joining the tokens of the first statement.
+        return ''.join(token.value for token in get_tokens(statement))
     function_value = {'count': '1', 'decode': "'1'"}
-    new_statement = ''
-    for token in get_tokens(statement):
+    values = []
+    # The parse tree is needed to find the enclosing function, so it is not taken from the token cache,
+    # but the rewritten statement is cached.
+    for token in sqlparse.parse(statement)[0].flatten():
         value = token.value
         if token.ttype is Name.Placeholder and token.value == '?':
             function_token = None
@@ -47,8 +127,8 @@ def replace_function_comma(statement):
             if function_token:
                 replaced_value = function_value.get(function_token.get_name().lower(), None)
                 value = replaced_value if replaced_value else value
-        new_statement += value
-    return new_statement
+        values.append(value)
+    return ''.join(values)
 
 
 class UniqueList(list):
@@ -119,7 +199,13 @@ class ExistingIndex:
 
 
 class AdvisedIndex:
+    __slots__ = ('__id', '__key', '__table', '__columns', 'benefit', '__storage', '__index_type',
+                 'association_indexes', '__positive_queries', '__source_index', '__weakref__')
+
     def __init__(self, tbl, cols, index_type=None):
+        # Ids of the IndexItemFactory session, which key configurations as frozensets.
+        self.__id = IndexItemFactory().register(self)
+        self.__key = frozenset((self.__id,))
         self.__table = tbl
         self.__columns = cols
         self.benefit = 0
@@ -129,6 +215,13 @@ class AdvisedIndex:
         self.__positive_queries = []
         self.__source_index = None
 
+    def get_id(self):
+        return self.__id
+
+    def get_key(self):
+        """The configuration key of this index alone, see get_config_key."""
+        return self.__key
+
     def set_source_index(self, source_index: ExistingIndex):
         self.__source_index = source_index
 
@@ -195,6 +288,77 @@ class AdvisedIndex:
         return self.__str__()
 
 
+class MemoCache:
+    """Bounded LRU mapping whose entries may also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=DEFAULT_MEMO_SIZE, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self.__entries.get(key)
+        if entry is not None and (self.ttl is None or time.monotonic() - entry[1] < self.ttl):
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self.__entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.__entries[key] = (value, time.monotonic())
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+
+    def clear(self):
+        self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self), 'maxsize': self.maxsize}
+
+
+def memoize_method(maxsize=DEFAULT_MEMO_SIZE, ttl=None, key=None):
+    """Like lru_cache, but the cache is kept on the instance, so it is bounded per object
+    and released together with it instead of pinning every instance for the process lifetime.
+    `key` maps the call arguments to the cache key, the arguments themselves by default."""
+    def decorator(func):
+        name = func.__name__
+
+        @wraps(func)
+        def wrapper(self, *args):
+            caches = self.__dict__.setdefault(MEMO_CACHES_ATTR, {})
+            cache = caches.get(name)
+            if cache is None:
+                cache = caches[name] = MemoCache(maxsize, ttl)
+            cache_key = key(*args) if key else args
+            result = cache.get(cache_key, _MISSING)
+            if result is _MISSING:
+                result = func(self, *args)
+                cache.put(cache_key, result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def clear_memo_caches(obj):
+    for cache in obj.__dict__.get(MEMO_CACHES_ATTR, {}).values():
+        cache.clear()
+
+
+def get_memo_stats(obj):
+    return {name: cache.get_stats() for name, cache in obj.__dict__.get(MEMO_CACHES_ATTR, {}).items()}
+
+
 def singleton(cls):
     instances = {}
 
@@ -210,6 +374,24 @@ def singleton(cls):
 class IndexItemFactory:
     def __init__(self):
         self.indexes = {}
+        # Only decodes configuration keys, so it must not keep indexes alive.
+        self.indexes_by_id = weakref.WeakValueDictionary()
+        self.next_id = 0
+
+    def register(self, index: AdvisedIndex):
+        """Give the index the next id of the current session."""
+        index_id = self.next_id
+        self.next_id += 1
+        self.indexes_by_id[index_id] = index
+        return index_id
+
+    def reset(self):
+        """Start a new analysis session, releasing the indexes of the previous one. Ids restart
+        from 0, so its indexes, workloads and configuration keys must not be used any more."""
+        self.indexes = {}
+        self.indexes_by_id = weakref.WeakValueDictionary()
+        self.next_id = 0
+        generate_placeholder_indexes.cache_clear()
 
     def get_index(self, tbl, cols, index_type):
         if COLUMN_DELIMITER not in cols:
@@ -218,6 +400,30 @@ class IndexItemFactory:
             self.indexes[(tbl, cols, index_type)] = AdvisedIndex(tbl, cols, index_type=index_type)
         return self.indexes[(tbl, cols, index_type)]
 
+    def get_indexes(self, config_key):
+        """Decode a configuration key back to its indexes, ordered by id."""
+        return tuple(self.indexes_by_id[index_id] for index_id in sorted(config_key))
+
+
+_EMPTY_CONFIG = frozenset()
+
+
+def get_config_key(indexes: (Sequence[AdvisedIndex], FrozenSet[int], None)):
+    """Key a configuration by the frozenset of its index ids, whose size and hash only depend
+    on the number of indexes; `None` and () are the empty configuration."""
+    if isinstance(indexes, frozenset):
+        return indexes
+    if not indexes:
+        return _EMPTY_CONFIG
+    if len(indexes) == 1:
+        return indexes[0].get_key()
+    return frozenset(index.get_id() for index in indexes)
+
+
+def get_config_args_key(*args):
+    """Cache key in which configuration arguments are replaced by their keys."""
+    return tuple(get_config_key(arg) if arg is None or isinstance(arg, tuple) else arg for arg in args)
+
 
 def match_table_name(table_name, tables):
     for elem in tables:
@@ -234,6 +440,7 @@ def match_table_name(table_name, tables):
 
 
 class QueryItem:
+    __slots__ = ('__statement', '__frequency', '__valid_index_list', '__benefit')
     __valid_index_list: List[AdvisedIndex]
 
     def __init__(self, sql: str, freq: float):
@@ -248,6 +455,9 @@ class QueryItem:
     def get_frequency(self):
         return self.__frequency
 
+    def add_frequency(self, freq):
+        self.__frequency += freq
+
     def append_index(self, index):
         self.__valid_index_list.append(index)
 
@@ -275,18 +485,30 @@ class QueryItem:
 
 
 class WorkLoad:
+    """Costs are kept in a dense matrix with one row per query and one column per
+    index configuration; `None` stands for the configuration without any index.
+    Configurations may be passed as tuples of indexes or as keys from get_config_key,
+    and are compared as sets of indexes."""
+
     def __init__(self, queries: List[QueryItem]):
         self.__indexes_list = []
         self.__queries = queries
-        self.__index_names_list = [[] for _ in range(len(self.__queries))]
-        self.__indexes_costs = [[] for _ in range(len(self.__queries))]
-        self.__plan_list = [[] for _ in range(len(self.__queries))]
+        self.__query_positions = {query: i for i, query in enumerate(queries)}
+        self.__indexes_columns = {}
+        self.__indexes_costs = np.zeros((len(queries), INITIAL_INDEXES_CAPACITY))
+        self.__index_names_list = []
+        self.__plan_list = []
+        self.__table_queries = None
+        self.__statement_types = None
 
     def get_queries(self) -> List[QueryItem]:
         return self.__queries
 
-    def has_indexes(self, indexes: Tuple[AdvisedIndex]):
-        return indexes in self.__indexes_list
+    def __get_column(self, indexes: (Tuple[AdvisedIndex], FrozenSet[int], None)):
+        return self.__indexes_columns[get_config_key(indexes)]
+
+    def has_indexes(self, indexes: (Tuple[AdvisedIndex], FrozenSet[int])):
+        return get_config_key(indexes) in self.__indexes_columns
 
     def get_used_index_names(self):
         used_indexes = set()
@@ -295,15 +517,14 @@ class WorkLoad:
                 used_indexes.add(index_name)
         return used_indexes
 
-    @lru_cache(maxsize=None)
-    def get_workload_used_indexes(self, indexes: (Tuple[AdvisedIndex], None)):
-        return list([index_names[self.__indexes_list.index(indexes if indexes else None)]
-                     for index_names in self.__index_names_list])
+    @memoize_method(key=get_config_args_key)
+    def get_workload_used_indexes(self, indexes: (Tuple[AdvisedIndex], FrozenSet[int], None)):
+        return list(self.__index_names_list[self.__get_column(indexes)])
 
     def get_query_advised_indexes(self, indexes, query):
-        query_idx = self.__queries.index(query)
-        indexes_idx = self.__indexes_list.index(indexes if indexes else None)
-        used_index_names = self.__index_names_list[indexes_idx][query_idx]
+        if isinstance(indexes, frozenset):
+            indexes = IndexItemFactory().get_indexes(indexes)
+        used_index_names = self.__index_names_list[self.__get_column(indexes)][self.__query_positions[query]]
         used_advised_indexes = []
         for index in indexes:
             for index_name in used_index_names:
@@ -312,105 +533,142 @@ class WorkLoad:
         return used_advised_indexes
 
     def set_index_benefit(self):
+        total_costs = self.get_total_costs()
+        origin_cost = total_costs[self.__get_column(None)]
         for indexes in self.__indexes_list:
             if indexes and len(indexes) == 1:
-                indexes[0].benefit = self.get_index_benefit(indexes[0])
+                indexes[0].benefit = origin_cost - total_costs[self.__get_column(indexes)]
 
     def replace_indexes(self, origin, new):
+        if isinstance(new, frozenset):
+            new = IndexItemFactory().get_indexes(new)
         if not new:
             new = None
-        self.__indexes_list[self.__indexes_list.index(origin if origin else None)] = new
-
-    @lru_cache(maxsize=None)
-    def get_total_index_cost(self, indexes: (Tuple[AdvisedIndex], None)):
-        return sum(
-            query_index_cost[self.__indexes_list.index(indexes if indexes else None)] for query_index_cost in
-            self.__indexes_costs)
-
-    @lru_cache(maxsize=None)
+        column = self.__indexes_columns.pop(get_config_key(origin))
+        self.__indexes_list[column] = new
+        self.__indexes_columns.setdefault(get_config_key(new), column)
+        self.invalidate_caches()
+
+    def get_total_costs(self):
+        """Total workload cost of every configuration, in the order they were added."""
+        return self.__indexes_costs[:, :len(self.__indexes_list)].sum(axis=0)
+
+    def get_indexes_benefits(self, indexes_list: List[Tuple[AdvisedIndex]]):
+        """Vectorized get_indexes_benefit over several configurations."""
+        columns = [self.__get_column(indexes) for indexes in indexes_list]
+        total_costs = self.__indexes_costs[:, columns].sum(axis=0)
+        return self.get_total_origin_cost() - total_costs
+
+    @memoize_method(key=get_config_args_key)
+    def get_total_index_cost(self, indexes: (Tuple[AdvisedIndex], FrozenSet[int], None)):
+        return float(self.__indexes_costs[:, self.__get_column(indexes)].sum())
+
+    @memoize_method()
     def get_total_origin_cost(self):
         return self.get_total_index_cost(None)
 
-    @lru_cache(maxsize=None)
-    def get_indexes_benefit(self, indexes: Tuple[AdvisedIndex]):
+    @memoize_method(key=get_config_args_key)
+    def get_indexes_benefit(self, indexes: (Tuple[AdvisedIndex], FrozenSet[int])):
         return self.get_total_origin_cost() - self.get_total_index_cost(indexes)
 
-    @lru_cache(maxsize=None)
+    @memoize_method()
     def get_index_benefit(self, index: AdvisedIndex):
-        return self.get_indexes_benefit(tuple([index]))
+        return self.get_indexes_benefit(index.get_key())
 
-    @lru_cache(maxsize=None)
-    def get_indexes_cost_of_query(self, query: QueryItem, indexes: (Tuple[AdvisedIndex], None)):
-        return self.__indexes_costs[self.__queries.index(query)][
-            self.__indexes_list.index(indexes if indexes else None)]
+    @memoize_method(key=get_config_args_key)
+    def get_indexes_cost_of_query(self, query: QueryItem, indexes: (Tuple[AdvisedIndex], FrozenSet[int], None)):
+        return float(self.__indexes_costs[self.__query_positions[query], self.__get_column(indexes)])
 
-    @lru_cache(maxsize=None)
-    def get_indexes_plan_of_query(self, query: QueryItem, indexes: (Tuple[AdvisedIndex], None)):
-        return self.__plan_list[self.__queries.index(query)][
-            self.__indexes_list.index(indexes if indexes else None)]
+    @memoize_method(key=get_config_args_key)
+    def get_indexes_plan_of_query(self, query: QueryItem, indexes: (Tuple[AdvisedIndex], FrozenSet[int], None)):
+        return self.__plan_list[self.__get_column(indexes)][self.__query_positions[query]]
 
-    @lru_cache(maxsize=None)
+    @memoize_method()
     def get_origin_cost_of_query(self, query: QueryItem):
         return self.get_indexes_cost_of_query(query, None)
 
-    @lru_cache(maxsize=None)
+    @memoize_method()
     def is_positive_query(self, index: AdvisedIndex, query: QueryItem):
-        return self.get_origin_cost_of_query(query) > self.get_indexes_cost_of_query(query, tuple([index]))
+        return self.get_origin_cost_of_query(query) > self.get_indexes_cost_of_query(query, index.get_key())
 
-    def add_indexes(self, indexes: (Tuple[AdvisedIndex], None), costs, index_names, plan_list):
+    def add_indexes(self, indexes: (Tuple[AdvisedIndex], FrozenSet[int], None), costs, index_names, plan_list):
+        if isinstance(indexes, frozenset):
+            indexes = IndexItemFactory().get_indexes(indexes)
         if not indexes:
             indexes = None
-        self.__indexes_list.append(indexes)
         if len(costs) != len(self.__queries):
             raise
-        for i, cost in enumerate(costs):
-            self.__indexes_costs[i].append(cost)
-            self.__index_names_list[i].append(index_names[i])
-            self.__plan_list[i].append(plan_list[i])
-
-    @lru_cache(maxsize=None)
+        column = len(self.__indexes_list)
+        if column == self.__indexes_costs.shape[1]:
+            # Grow geometrically so that appending configurations stays amortized O(queries).
+            self.__indexes_costs = np.concatenate((self.__indexes_costs, np.zeros_like(self.__indexes_costs)),
+                                                  axis=1)
+        self.__indexes_list.append(indexes)
+        # The first configuration added wins, as list.index() used to return it.
+        self.__indexes_columns.setdefault(get_config_key(indexes), column)
+        self.__indexes_costs[:, column] = costs
+        self.__index_names_list.append(list(index_names))
+        self.__plan_list.append(list(plan_list))
+        self.invalidate_caches()
+
+    def invalidate_caches(self):
+        clear_memo_caches(self)
+
+    def get_cache_stats(self):
+        return get_memo_stats(self)
+
+    def __build_table_queries(self):
+        """Index the queries by the tables they reference and classify their statement type once,
+        instead of scanning every statement with fresh regexes for each candidate index."""
+        self.__table_queries = defaultdict(list)
+        self.__statement_types = []
+        for position, query in enumerate(self.__queries):
+            statement = _IDENTIFIER_QUOTES.sub('', query.get_statement().lower())
+            self.__statement_types.append(get_statement_type(statement))
+            # Names are taken from the template, so words in string literals are not references.
+            template = _IDENTIFIER_QUOTES.sub('', get_statement_template(query.get_statement()))
+            for name in set(get_referenced_names(template)):
+                self.__table_queries[name].append(position)
+
+    def get_table_queries(self, table):
+        """Queries referencing the table either by its qualified name or by its bare name, in workload order."""
+        if self.__table_queries is None:
+            self.__build_table_queries()
+        table = table.lower()
+        positions = set(self.__table_queries.get(table, ()))
+        positions.update(self.__table_queries.get(table.split('.')[-1], ()))
+        return [self.__queries[position] for position in sorted(positions)]
+
+    @memoize_method()
     def get_index_related_queries(self, index: AdvisedIndex):
-        insert_queries = []
-        delete_queries = []
-        update_queries = []
-        select_queries = []
-        positive_queries = []
+        related_queries = {StatementType.INSERT: [], StatementType.DELETE: [],
+                           StatementType.UPDATE: [], StatementType.SELECT: []}
         ineffective_queries = []
         negative_queries = []
 
-        cur_table = index.get_table()
-        for query in self.get_queries():
-            if cur_table not in query.get_statement().lower() and \
-                    not re.search(r'((\A|[\s(,])%s[\s),])' % cur_table.split('.')[-1],
-                                  query.get_statement().lower()):
-                continue
-
-            if any(re.match(r'(insert\s+into\s+%s\s)' % table, query.get_statement().lower())
-                   for table in [cur_table, cur_table.split('.')[-1]]):
-                insert_queries.append(query)
-                if not self.is_positive_query(index, query):
-                    negative_queries.append(query)
-            elif any(re.match(r'(delete\s+from\s+%s\s)' % table, query.get_statement().lower()) or
-                     re.match(r'(delete\s+%s\s)' % table, query.get_statement().lower())
-                     for table in [cur_table, cur_table.split('.')[-1]]):
-                delete_queries.append(query)
-                if not self.is_positive_query(index, query):
-                    negative_queries.append(query)
-            elif any(re.match(r'(update\s+%s\s)' % table, query.get_statement().lower())
-                     for table in [cur_table, cur_table.split('.')[-1]]):
-                update_queries.append(query)
-                if not self.is_positive_query(index, query):
-                    negative_queries.append(query)
-            else:
-                select_queries.append(query)
-                if not self.is_positive_query(index, query):
+        cur_table = index.get_table().lower()
+        target_tables = (cur_table, cur_table.split('.')[-1])
+        for query in self.get_table_queries(cur_table):
+            statement_type, target_table = self.__statement_types[self.__query_positions[query]]
+            if target_table not in target_tables:
+                statement_type = StatementType.SELECT
+            related_queries[statement_type].append(query)
+            if not self.is_positive_query(index, query):
+                if statement_type is StatementType.SELECT:
                     ineffective_queries.append(query)
-            positive_queries = [query for query in insert_queries + delete_queries + update_queries + select_queries
-                                if query not in negative_queries + ineffective_queries]
+                else:
+                    negative_queries.append(query)
+        insert_queries = related_queries[StatementType.INSERT]
+        delete_queries = related_queries[StatementType.DELETE]
+        update_queries = related_queries[StatementType.UPDATE]
+        select_queries = related_queries[StatementType.SELECT]
+        non_positive_queries = set(negative_queries + ineffective_queries)
+        positive_queries = [query for query in insert_queries + delete_queries + update_queries + select_queries
+                            if query not in non_positive_queries]
         return insert_queries, delete_queries, update_queries, select_queries, \
             positive_queries, ineffective_queries, negative_queries
 
-    @lru_cache(maxsize=None)
+    @memoize_method()
     def get_index_sql_num(self, index: AdvisedIndex):
         insert_queries, delete_queries, update_queries, \
             select_queries, positive_queries, ineffective_queries, \
@@ -448,33 +706,107 @@ def is_subset_index(indexes1: Tuple[AdvisedIndex], indexes2: Tuple[AdvisedIndex]
     return existing
 
 
-def lookfor_subsets_configs(config: List[AdvisedIndex], atomic_config_total: List[Tuple[AdvisedIndex]]):
-    """ Look for the subsets of a given config in the atomic configs. """
-    contained_atomic_configs = []
-    for atomic_config in atomic_config_total:
-        if len(atomic_config) == 1:
-            continue
-        if not is_subset_index(atomic_config, tuple(config)):
-            continue
-        # Atomic_config should contain the latest candidate_index.
-        if not any(is_subset_index((atomic_index,), (config[-1],)) for atomic_index in atomic_config):
-            continue
-        # Filter redundant config in contained_atomic_configs.
-        for contained_atomic_config in contained_atomic_configs[:]:
-            if is_subset_index(contained_atomic_config, atomic_config):
-                contained_atomic_configs.remove(contained_atomic_config)
+def get_index_prefix_keys(index: AdvisedIndex):
+    """Keys of the indexes which `index` covers: same table and type, with a prefix of its columns."""
+    columns = index.get_columns().split(COLUMN_DELIMITER)
+    return [(index.get_table(), index.get_index_type(), COLUMN_DELIMITER.join(columns[:i]))
+            for i in range(1, len(columns) + 1)]
+
+
+class AtomicConfigLattice:
+    """Atomic configs encoded as bitsets over their distinct indexes, so that subset tests are
+    integer operations. It can be used wherever a list of atomic configs is expected, and
+    configs can be added incrementally."""
+
+    def __init__(self, atomic_configs: Sequence[Tuple[AdvisedIndex]] = ()):
+        self.__configs = []
+        self.__bits = {}
+        self.__masks = []
+        # Atomic indexes covered by the indexes of each config, see is_subset_index.
+        self.__closures = []
+        self.__configs_by_bit = defaultdict(list)
+        self.__configs_by_prefix = defaultdict(list)
+        for atomic_config in atomic_configs:
+            self.add(atomic_config)
+
+    def __len__(self):
+        return len(self.__configs)
+
+    def __iter__(self):
+        return iter(self.__configs)
+
+    def __getitem__(self, item):
+        return self.__configs[item]
+
+    def __get_bit(self, key):
+        bit = self.__bits.get(key)
+        if bit is None:
+            bit = self.__bits[key] = 1 << len(self.__bits)
+            # Configs added earlier which cover the new index now cover its bit as well.
+            for position in self.__configs_by_prefix.get(key, ()):
+                self.__closures[position] |= bit
+        return bit
+
+    def add(self, atomic_config: Tuple[AdvisedIndex]):
+        position = len(self.__configs)
+        self.__configs.append(atomic_config)
+        self.__closures.append(0)
+        mask = 0
+        for index in atomic_config:
+            bit = self.__get_bit(get_index_prefix_keys(index)[-1])
+            if not mask & bit:
+                self.__configs_by_bit[bit].append(position)
+            mask |= bit
+        self.__masks.append(mask)
+        for index in atomic_config:
+            for key in get_index_prefix_keys(index):
+                self.__configs_by_prefix[key].append(position)
+        self.__closures[position] = self.get_covered_mask(atomic_config)
+
+    def __get_covered_bits(self, index: AdvisedIndex):
+        return [self.__bits[key] for key in get_index_prefix_keys(index) if key in self.__bits]
+
+    def get_covered_mask(self, config: Sequence[AdvisedIndex]):
+        mask = 0
+        for index in config:
+            for bit in self.__get_covered_bits(index):
+                mask |= bit
+        return mask
+
+    def lookfor_subsets_configs(self, config: List[AdvisedIndex]):
+        covered_mask = self.get_covered_mask(config)
+        # Only the configs holding an index covered by the latest candidate index may qualify.
+        candidates = sorted(set(position for bit in self.__get_covered_bits(config[-1])
+                                for position in self.__configs_by_bit[bit]))
+        contained_positions = []
+        for position in candidates:
+            atomic_config = self.__configs[position]
+            if len(atomic_config) == 1 or len(atomic_config) > len(config):
+                continue
+            if self.__masks[position] & ~covered_mask:
+                continue
+            # Filter redundant config in contained_atomic_configs.
+            contained_positions = [contained for contained in contained_positions
+                                   if len(self.__configs[contained]) > len(atomic_config)
+                                   or self.__masks[contained] & ~self.__closures[position]]
+            contained_positions.append(position)
+        return [self.__configs[position] for position in contained_positions]
 
-        contained_atomic_configs.append(atomic_config)
 
-    return contained_atomic_configs
+def lookfor_subsets_configs(config: List[AdvisedIndex], atomic_config_total: Sequence[Tuple[AdvisedIndex]]):
+    """ Look for the subsets of a given config in the atomic configs.
+    Pass an AtomicConfigLattice as atomic_config_total to reuse it across calls. """
+    if not isinstance(atomic_config_total, AtomicConfigLattice):
+        atomic_config_total = AtomicConfigLattice(atomic_config_total)
+    return atomic_config_total.lookfor_subsets_configs(config)
 
 
 def match_columns(column1, column2):
-    return re.match(column1 + ',', column2 + ',')
+    return (column2 + ',').startswith(column1 + ',')
 
 
 def infer_workload_benefit(workload: WorkLoad, config: List[AdvisedIndex],
-                           atomic_config_total: List[Tuple[AdvisedIndex]]):
+                           atomic_config_total: Sequence[Tuple[AdvisedIndex]]):
     """ Infer the total cost of queries for a config according to the cost of atomic configs. """
     total_benefit = 0
     atomic_subsets_configs = lookfor_subsets_configs(config, atomic_config_total)
@@ -486,10 +818,10 @@ def infer_workload_benefit(workload: WorkLoad, config: List[AdvisedIndex],
         # When there are multiple indexes, the benefit is the total benefit
         # of the multiple indexes minus the benefit of every single index.
         total_benefit += \
-            origin_cost_of_query - workload.get_indexes_cost_of_query(query, (config[-1],))
+            origin_cost_of_query - workload.get_indexes_cost_of_query(query, config[-1].get_key())
         for k, sub_config in enumerate(atomic_subsets_configs):
             single_index_total_benefit = sum(origin_cost_of_query -
-                                             workload.get_indexes_cost_of_query(query, (index,))
+                                             workload.get_indexes_cost_of_query(query, index.get_key())
                                              for index in sub_config)
             portfolio_returns = \
                 origin_cost_of_query \
@@ -511,18 +843,165 @@ def infer_workload_benefit(workload: WorkLoad, config: List[AdvisedIndex],
     return total_benefit
 
 
-@lru_cache(maxsize=None)
-def get_tokens(query):
-    return list(sqlparse.parse(query)[0].flatten())
+def lazy_greedy_determine_opt_config(workload: WorkLoad, atomic_config_total: Sequence[Tuple[AdvisedIndex]],
+                                     candidate_indexes: Sequence[AdvisedIndex], max_index_num=None,
+                                     storage_budget=None):
+    """Greedily add the candidate with the largest marginal benefit, as long as it is positive,
+    within `max_index_num` indexes and `storage_budget` (the sum of their get_storage()).
 
+    Candidates are kept in a max-heap of their last known marginal benefit. As benefits
+    mostly shrink when the configuration grows, only the top of the heap is re-evaluated
+    against the current configuration, and it is selected once its fresh benefit stays on top.
+    """
+    if not isinstance(atomic_config_total, AtomicConfigLattice):
+        atomic_config_total = AtomicConfigLattice(atomic_config_total)
+    opt_config = []
+    used_storage = 0
+    # (-marginal benefit, position in candidate_indexes, size of opt_config it was computed with)
+    heap = []
+    for position, index in enumerate(candidate_indexes):
+        if storage_budget is not None and index.get_storage() > storage_budget:
+            continue
+        heap.append((-infer_workload_benefit(workload, [index], atomic_config_total), position, 0))
+    heapq.heapify(heap)
+    while heap and (max_index_num is None or len(opt_config) < max_index_num):
+        negative_benefit, position, evaluated_size = heapq.heappop(heap)
+        index = candidate_indexes[position]
+        if storage_budget is not None and used_storage + index.get_storage() > storage_budget:
+            # The remaining budget only shrinks, so the candidate can never fit again.
+            continue
+        if evaluated_size != len(opt_config):
+            # The inferred benefit of a config is the benefit its last index adds to the others.
+            benefit = infer_workload_benefit(workload, opt_config + [index], atomic_config_total)
+            heapq.heappush(heap, (-benefit, position, len(opt_config)))
+            continue
+        if -negative_benefit <= 0:
+            break
+        opt_config.append(index)
+        used_storage += index.get_storage()
+    return opt_config
 
-@lru_cache(maxsize=None)
+
+# Flattened sqlparse token without the parse tree it belongs to.
+CompactToken = namedtuple('CompactToken', ['ttype', 'value'])
+
+
+def _get_token_type(name):
+    ttype = TokenType
+    for part in name.split('.')[1:]:
+        ttype = getattr(ttype, part)
+    return ttype
+
+
+class TokenCache:
+    """Bounded LRU cache of the tokens sqlparse finds in the first statement of queries.
+
+    A tokenization is kept as an array of token type codes and an array of offsets into
+    the query, instead of sqlparse objects linked to their whole parse tree. With `path`
+    the tokenizations are also stored in a SQLite file and reused by later runs.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, path=None):
+        self.__entries = MemoCache(maxsize)
+        # Token type codes are only meaningful in this process; stored rows name their types.
+        self.__types = []
+        self.__codes = {}
+        self.__lock = threading.Lock()
+        self.__conn = None
+        self.__pending_entries = []
+        if path:
+            self.__conn = sqlite3.connect(path, check_same_thread=False)
+            self.__conn.execute('CREATE TABLE IF NOT EXISTS token_entries '
+                                '(query TEXT PRIMARY KEY, type_names TEXT, types BLOB, offsets BLOB)')
+            atexit.register(self.close)
+
+    def __get_code(self, ttype):
+        code = self.__codes.get(ttype)
+        if code is None:
+            code = self.__codes[ttype] = len(self.__types)
+            self.__types.append(ttype)
+        return code
+
+    def __tokenize(self, query):
+        types, offsets = array('H'), array('I', [0])
+        for token in sqlparse.parse(query)[0].flatten():
+            types.append(self.__get_code(token.ttype))
+            offsets.append(offsets[-1] + len(token.value))
+        return types, offsets
+
+    def __load(self, query):
+        row = self.__conn.execute('SELECT type_names, types, offsets FROM token_entries WHERE query = ?',
+                                  (query,)).fetchone()
+        if row is None:
+            return None
+        # The stored codes index the row's own list of type names.
+        codes = [self.__get_code(_get_token_type(name)) for name in row[0].split()]
+        local_types, offsets = array('H'), array('I')
+        local_types.frombytes(row[1])
+        offsets.frombytes(row[2])
+        return array('H', (codes[code] for code in local_types)), offsets
+
+    def __dump(self, query, entry):
+        types, offsets = entry
+        local_codes = {}
+        local_types = array('H', (local_codes.setdefault(code, len(local_codes)) for code in types))
+        type_names = ' '.join(str(self.__types[code]) for code in local_codes)
+        return query, type_names, local_types.tobytes(), offsets.tobytes()
+
+    def get_tokens(self, query) -> List[CompactToken]:
+        with self.__lock:
+            entry = self.__entries.get(query)
+            if entry is None and self.__conn is not None:
+                entry = self.__load(query)
+            if entry is None:
+                entry = self.__tokenize(query)
+                if self.__conn is not None:
+                    self.__pending_entries.append(self.__dump(query, entry))
+                    if len(self.__pending_entries) >= TOKEN_CACHE_FLUSH_SIZE:
+                        self.__flush()
+            self.__entries.put(query, entry)
+        types, offsets = entry
+        return [CompactToken(self.__types[code], query[offsets[i]:offsets[i + 1]]) for i, code in enumerate(types)]
+
+    def __flush(self):
+        with self.__conn:
+            self.__conn.executemany('INSERT OR REPLACE INTO token_entries VALUES (?, ?, ?, ?)',
+                                    self.__pending_entries)
+        self.__pending_entries = []
+
+    def get_stats(self):
+        return self.__entries.get_stats()
+
+    def close(self):
+        with self.__lock:
+            if self.__conn is None:
+                return
+            self.__flush()
+            self.__conn.close()
+            self.__conn = None
+
+
+_token_cache = TokenCache()
+
+
+def set_token_cache(maxsize=TOKEN_CACHE_SIZE, path=None):
+    """Replace the tokenization cache, e.g. to persist it to a SQLite file across runs."""
+    global _token_cache
+    _token_cache.close()
+    _token_cache = TokenCache(maxsize, path)
+
+
+def get_tokens(query) -> List[CompactToken]:
+    return _token_cache.get_tokens(query)
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
 def has_dollar_placeholder(query):
     tokens = get_tokens(query)
     return any(item.ttype is Name.Placeholder for item in tokens)
 
 
-@lru_cache(maxsize=None)
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
 def get_placeholders(query):
     placeholders = set()
     for item in get_tokens(query):
@@ -0,0 +1,281 @@
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    from .executors.common import BaseExecutor
+    from .utils import (AdvisedIndex, ERROR_KEYWORD, EXPLAIN_SUFFIX, IndexItemFactory, QUERY_PLAN_SUFFIX, QueryItem,
+                        WorkLoad, get_config_key, hypo_index_ctx, split_iter)
+    from .plan_cache import PlanCostCache, get_config_signature
+except ImportError:
+    from executors.common import BaseExecutor
+    from utils import (AdvisedIndex, ERROR_KEYWORD, EXPLAIN_SUFFIX, IndexItemFactory, QUERY_PLAN_SUFFIX, QueryItem,
+                       WorkLoad, get_config_key, hypo_index_ctx, split_iter)
+    from plan_cache import PlanCostCache, get_config_signature
+
+_TOTAL_COST_PATTERN = re.compile(r'cost=[\d.]+\.\.([\d.]+)')
+_ROWS_FOOTER_PATTERN = re.compile(r'\(\d+ rows?\)$')
+_USED_INDEX_PATTERN = re.compile(r'(?:Index (?:Only )?Scan(?: Backward)? using|Bitmap Index Scan on)\s+(\S+)')
+
+
+def get_hypo_index_select(index: AdvisedIndex):
+    """A SELECT creating the hypothetical index and returning its (oid, name)."""
+    statement = 'CREATE INDEX ON %s(%s)%s' % (index.get_table(), index.get_columns(),
+                                            ' ' + index.get_index_type() if index.get_index_type() else '')
+    return "SELECT * FROM pg_catalog.hypopg_create_index('%s')" % statement.replace("'", "''")
+
+
+def parse_explain_results(results) -> List[Tuple[Optional[float], List[str], str]]:
+    """Split the rows returned for a list of EXPLAIN statements into the (total cost,
+    used index names, plan text) of each statement. A plan starts at the EXPLAIN status
+    row of a driver or the QUERY PLAN header of gsql, and ends at gsql's row count footer.
+    Statements whose plan has no parsable cost, e.g. failed ones, get a cost of None."""
+    explained = []
+    plan_lines = None
+    for _tuple in results or ():
+        line = str(_tuple[0])
+        if line == EXPLAIN_SUFFIX or line.strip() == QUERY_PLAN_SUFFIX or line.startswith(ERROR_KEYWORD):
+            plan_lines = [line] if line.startswith(ERROR_KEYWORD) else []
+            explained.append(plan_lines)
+        elif _ROWS_FOOTER_PATTERN.match(line):
+            plan_lines = None
+        elif plan_lines is not None:
+            plan_lines.append(line)
+    parsed = []
+    for plan_lines in explained:
+        match = _TOTAL_COST_PATTERN.search(plan_lines[0]) if plan_lines else None
+        cost = float(match.group(1)) if match else None
+        used_indexes = [name for line in plan_lines for name in _USED_INDEX_PATTERN.findall(line)]
+        parsed.append((cost, used_indexes, '\n'.join(plan_lines)))
+    return parsed
+
+
+class WhatIfEngine:
+    """Cost index configurations of a workload with hypothetical indexes.
+
+    Configurations are visited grouped by the tables they index, and consecutive ones
+    share most of their indexes, so moving from one to the next only drops and creates
+    the indexes which differ, in one round-trip each, instead of resetting everything.
+    Only the queries referencing an indexed table are explained again; the others keep
+    the costs they have without any index.
+    """
+
+    def __init__(self, executor: BaseExecutor, workload: WorkLoad, cost_cache: Optional[PlanCostCache] = None):
+        self.executor = executor
+        self.workload = workload
+        # Costs measured by earlier runs, which spare both the EXPLAIN and the index switch.
+        self.cost_cache = cost_cache
+        # Index id to the (oid, name) of its hypothetical index while it exists.
+        self.__hypo_indexes: Dict[int, Tuple[str, str]] = {}
+        # Queries without a cost of their own, which are left out of every configuration.
+        self.failed_queries = set()
+        self.round_trips = 0
+
+    def __explain(self, queries: Sequence[QueryItem]):
+        if not queries:
+            return []
+        self.round_trips += 1
+        sqls = ['EXPLAIN ' + query.get_statement() for query in queries]
+        explained = parse_explain_results(self.executor.execute_sqls(sqls))
+        if len(explained) != len(queries):
+            # Some statement returned nothing recognizable, so match them up one by one.
+            logging.warning('Got %d plans for %d statements, explaining them separately.',
+                            len(explained), len(queries))
+            explained = []
+            for sql in sqls:
+                self.round_trips += 1
+                plans = parse_explain_results(self.executor.execute_sqls([sql]))
+                explained.append(plans[0] if plans else (None, [], ''))
+        return explained
+
+    def __get_plans(self, queries: Sequence[QueryItem], indexes: Sequence[AdvisedIndex]):
+        """The (cost, used index names, plan) of the queries under the configuration, taken
+        from the cost cache where possible. The indexes are only switched to for the others."""
+        signature = get_config_signature(indexes)
+        statements = [query.get_statement() for query in queries]
+        plans = self.cost_cache.get_many(statements, signature) if self.cost_cache else [None] * len(queries)
+        missing = [position for position, plan in enumerate(plans) if plan is None]
+        if not missing:
+            return plans
+        self.__switch_to(indexes)
+        for position, plan in zip(missing, self.__explain([queries[position] for position in missing])):
+            plans[position] = plan
+        if self.cost_cache is not None:
+            self.cost_cache.put_many([(statements[position],) + tuple(plans[position]) for position in missing],
+                                     signature)
+        return plans
+
+    def __switch_to(self, indexes: Sequence[AdvisedIndex]):
+        """Drop the hypothetical indexes which are not in the configuration and create the missing ones."""
+        wanted = {index.get_id(): index for index in indexes}
+        dropped = [index_id for index_id in self.__hypo_indexes if index_id not in wanted]
+        if dropped:
+            self.round_trips += 1
+            self.executor.execute_batch(['SELECT %s;' % ', '.join('pg_catalog.hypopg_drop_index(%s)'
+                                                                  % self.__hypo_indexes[index_id][0]
+                                                                  for index_id in dropped)])
+            for index_id in dropped:
+                del self.__hypo_indexes[index_id]
+        created = [index for index_id, index in wanted.items() if index_id not in self.__hypo_indexes]
+        if created:
+            self.round_trips += 1
+            rows = [_tuple for _tuple in self.executor.execute_sqls(
+                [' UNION ALL '.join(get_hypo_index_select(index) for index in created) + ';'])
+                    if len(_tuple) == 2]
+            if len(rows) != len(created):
+                raise RuntimeError('Failed to create hypothetical indexes: %s' % rows)
+            for index, (oid, name) in zip(created, rows):
+                self.__hypo_indexes[index.get_id()] = (oid, name)
+
+    def __get_origin(self):
+        if not self.workload.has_indexes(None):
+            queries = self.workload.get_queries()
+            explained = self.__get_plans(queries, ())
+            self.failed_queries = set(query for query, (cost, _, _) in zip(queries, explained) if cost is None)
+            if self.failed_queries:
+                logging.warning('Failed to explain %d statements, their costs are left out.', len(self.failed_queries))
+            self.workload.add_indexes(None, [cost or 0 for cost, _, _ in explained],
+                                      [names for _, names, _ in explained], [plan for _, _, plan in explained])
+        return (self.workload.get_indexes_cost_of_query, self.workload.get_workload_used_indexes(None),
+                self.workload.get_indexes_plan_of_query)
+
+    def __cost_config(self, indexes: Sequence[AdvisedIndex]):
+        get_cost, origin_index_names, get_plan = self.__get_origin()
+        queries = self.workload.get_queries()
+        costs = [get_cost(query, None) for query in queries]
+        index_names = list(origin_index_names)
+        plans = [get_plan(query, None) for query in queries]
+        affected = set()
+        for table in set(index.get_table() for index in indexes):
+            affected.update(self.workload.get_table_queries(table))
+        positions = [position for position, query in enumerate(queries)
+                     if query in affected and query not in self.failed_queries]
+
+        explained = self.__get_plans([queries[position] for position in positions], indexes)
+        for position, (cost, names, plan) in zip(positions, explained):
+            # A failed plan keeps the cost the query has without any index.
+            if cost is not None:
+                costs[position] = cost
+                index_names[position] = names
+                plans[position] = plan
+        self.workload.add_indexes(tuple(indexes), costs, index_names, plans)
+
+    def evaluate(self, configs: Iterable[Optional[Sequence[AdvisedIndex]]]):
+        """Add the costs of all the configurations which the workload does not know yet."""
+        ordered = order_configs(self.workload, configs)
+        with hypo_index_ctx(self.executor):
+            self.__get_origin()
+            for config in ordered:
+                self.__cost_config(config)
+            self.__hypo_indexes.clear()
+
+
+def get_origin_costs(executor: BaseExecutor, queries: Sequence[QueryItem]) -> List[float]:
+    """Costs of the queries without any hypothetical index, e.g. for estimate_compression_error."""
+    workload = WorkLoad(list(queries))
+    WhatIfEngine(executor, workload).evaluate(())
+    return [workload.get_origin_cost_of_query(query) for query in queries]
+
+
+def order_configs(workload: WorkLoad, configs) -> List[Tuple[AdvisedIndex]]:
+    """The distinct configurations missing from the workload, with configurations on the
+    same tables next to each other, and those sharing a prefix of index ids in sequence."""
+    pending = {}
+    for config in configs:
+        if isinstance(config, frozenset):
+            config = IndexItemFactory().get_indexes(config)
+        if config and not workload.has_indexes(tuple(config)):
+            pending.setdefault(get_config_key(tuple(config)), tuple(config))
+    return sorted(pending.values(), key=lambda config: (sorted(set(index.get_table() for index in config)),
+                                                        sorted(index.get_id() for index in config)))
+
+
+# The executor and cost cache of a costing worker process, opened once by its initializer.
+_worker_executor = None
+_worker_cost_cache = None
+
+
+def _init_costing_worker(executor_cls, executor_args, cost_cache_args):
+    global _worker_executor, _worker_cost_cache
+    _worker_executor = executor_cls(*executor_args)
+    if cost_cache_args:
+        _worker_cost_cache = PlanCostCache(*cost_cache_args)
+
+
+def _cost_shard(statements, origin, index_specs):
+    """Cost a shard of configurations, given as (table, columns, index type) triples, in a
+    worker process, given the (costs, used index names, plans) of the configuration without
+    indexes. Return those of every configuration of the shard."""
+    # Every shard is a session of its own, so ids do not keep growing in long-lived workers.
+    IndexItemFactory().reset()
+    queries = [QueryItem(statement, 0) for statement in statements]
+    workload = WorkLoad(queries)
+    workload.add_indexes(None, *origin)
+    configs = [tuple(IndexItemFactory().get_index(*spec) for spec in config) for config in index_specs]
+    WhatIfEngine(_worker_executor, workload, _worker_cost_cache).evaluate(configs)
+    return [([workload.get_indexes_cost_of_query(query, config) for query in queries],
+             workload.get_workload_used_indexes(config),
+             [workload.get_indexes_plan_of_query(query, config) for query in queries])
+            for config in configs]
+
+
+class CostingScheduler:
+    """Cost configurations with one WhatIfEngine per worker process.
+
+    The ordered configurations are cut with split_iter into one contiguous shard per
+    worker, so configurations on the same tables mostly stay together, and each worker
+    opens its own connection with `executor_cls(*executor_args)`, since hypothetical
+    indexes only exist in the session which created them. The shards' results are added
+    to the workload in the order of the configurations, whichever worker finishes first.
+    The configuration without indexes is costed once, in this process, and handed to the
+    workers. With `cost_cache_args`, the (path, schema version) of a PlanCostCache, every
+    process reuses the costs stored in that file.
+    """
+
+    def __init__(self, executor_cls, executor_args, workers=None, cost_cache_args=None):
+        self.executor_cls = executor_cls
+        self.executor_args = tuple(executor_args)
+        self.cost_cache_args = tuple(cost_cache_args) if cost_cache_args else None
+        self.workers = max(1, workers or os.cpu_count() or 1)
+
+    def __cost_origin(self, workload: WorkLoad):
+        """Cost the configuration without indexes and return the queries which failed."""
+        executor = self.executor_cls(*self.executor_args)
+        cost_cache = PlanCostCache(*self.cost_cache_args) if self.cost_cache_args else None
+        engine = WhatIfEngine(executor, workload, cost_cache)
+        with executor.session():
+            engine.evaluate(())
+        if cost_cache is not None:
+            cost_cache.close()
+        return engine.failed_queries
+
+    def evaluate(self, workload: WorkLoad, configs: Iterable[Optional[Sequence[AdvisedIndex]]]):
+        ordered = order_configs(workload, configs)
+        failed = self.__cost_origin(workload) if not workload.has_indexes(None) else set()
+        if not ordered:
+            return
+        # Queries which failed without indexes keep their origin cost, so workers skip them.
+        positions = [position for position, query in enumerate(workload.get_queries()) if query not in failed]
+        queries = [workload.get_queries()[position] for position in positions]
+        origin_costs = [workload.get_origin_cost_of_query(query) for query in workload.get_queries()]
+        origin_names = workload.get_workload_used_indexes(None)
+        origin_plans = [workload.get_indexes_plan_of_query(query, None) for query in workload.get_queries()]
+        origin = ([origin_costs[position] for position in positions],
+                  [origin_names[position] for position in positions],
+                  [origin_plans[position] for position in positions])
+        shards = [shard for shard in split_iter(ordered, self.workers) if shard]
+        statements = [query.get_statement() for query in queries]
+        index_specs = [[[(index.get_table(), index.get_columns(), index.get_index_type()) for index in config]
+                        for config in shard] for shard in shards]
+        with ProcessPoolExecutor(max_workers=len(shards), initializer=_init_costing_worker,
+                                 initargs=(self.executor_cls, self.executor_args, self.cost_cache_args)) as pool:
+            shard_results = list(pool.map(_cost_shard, repeat(statements), repeat(origin), index_specs))
+        for shard, results in zip(shards, shard_results):
+            for config, (shard_costs, shard_names, shard_plans) in zip(shard, results):
+                costs, index_names, plans = list(origin_costs), list(origin_names), list(origin_plans)
+                for position, cost, names, plan in zip(positions, shard_costs, shard_names, shard_plans):
+                    costs[position], index_names[position], plans[position] = cost, names, plan
+                workload.add_indexes(config, costs, index_names, plans)
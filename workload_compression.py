@@ -0,0 +1,224 @@
+import random
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, List, Sequence, Tuple
+
+try:
+    from .utils import QueryItem, get_statement_type
+    from .workload_reader import get_statement_template
+except ImportError:
+    from utils import QueryItem, get_statement_type
+    from workload_reader import get_statement_template
+
+DEFAULT_SIMILARITY = 0.8
+DEFAULT_SAMPLE_SIZE = 200
+
+_IDENTIFIER_QUOTES = re.compile(r'[\[\]"`]')
+_IDENTIFIER = r'[a-z_#@$][\w#@$]*(?:\.[a-z_#@$][\w#@$]*)*'
+_FROM = re.compile(r'\bfrom\b')
+_FROM_END = re.compile(r'\b(?:where|group|order|having|limit|offset|union|intersect|except|fetch|returning|window|'
+                       r'for)\b|;')
+_FROM_ITEM_SEPARATOR = re.compile(r',|\b(?:(?:natural|left|right|full|inner|cross)\s+)*(?:outer\s+)?join\b')
+_JOIN_CONDITION = re.compile(r'\b(?:on|using)\b')
+_ALIAS = r'(?:\s+(?:as\s+)?(?!(?:set|values|select|default|on|using)\b)([a-z_][\w$]*))?'
+_FROM_ITEM = re.compile(r'\s*(%s)%s\s*$' % (_IDENTIFIER, _ALIAS))
+_TABLE_REFERENCE = re.compile(r'\b(?:join|update|into)\s+(%s)%s' % (_IDENTIFIER, _ALIAS))
+# Assignments of an UPDATE, which are neither predicates nor join keys.
+_SET_LIST = re.compile(r'\bset\b.*?(?=\b(?:where|from|output|returning)\b|$)')
+_JOIN_KEY = re.compile(r'(%s)\s*=\s*(%s)' % (_IDENTIFIER, _IDENTIFIER))
+_PREDICATE = re.compile(r'(%s)\s*(<>|!=|<=|>=|=|<|>|\bnot\s+like\b|\blike\b|\bnot\s+in\b|\bin\b|\bbetween\b|'
+                        r'\bis\s+not\s+null\b|\bis\s+null\b)' % _IDENTIFIER)
+_CLAUSE = re.compile(r'\b(group|order)\s+by\s+(.*?)(?=\b(?:having|order|limit|offset|union|fetch)\b|$)')
+_KEYWORDS = frozenset(['select', 'from', 'where', 'and', 'or', 'not', 'on', 'join', 'as', 'null', 'case', 'when',
+                       'then', 'else', 'end', 'exists', 'in', 'like', 'between', 'is'])
+
+
+def _outside_parentheses(text):
+    # The text up to the end of the enclosing parenthesis, without what is nested in
+    # parentheses, e.g. subqueries in a FROM list, whose own FROM lists are read apart.
+    depth = 0
+    kept = []
+    for char in text:
+        if char == ')':
+            depth -= 1
+            if depth < 0:
+                break
+        if depth == 0:
+            kept.append(char)
+        if char == '(':
+            depth += 1
+    return ''.join(kept)
+
+
+def get_table_aliases(template) -> Dict[str, str]:
+    """Map every table of a statement template, and the alias and unqualified name it may
+    be referenced with, to the table, e.g. {'o': 'orders', 'orders': 'orders'}. Every item
+    of a FROM list is read, as well as JOIN, UPDATE and INSERT INTO targets."""
+    references = []
+    for match in _FROM.finditer(template):
+        from_list = _FROM_END.split(_outside_parentheses(template[match.end():]), 1)[0]
+        for item in _FROM_ITEM_SEPARATOR.split(from_list):
+            item_match = _FROM_ITEM.match(_JOIN_CONDITION.split(item, 1)[0])
+            if item_match:
+                references.append(item_match.groups())
+    references.extend(_TABLE_REFERENCE.findall(template))
+    aliases = {}
+    for table, alias in references:
+        if table in _KEYWORDS:
+            continue
+        aliases.setdefault(table.split('.')[-1], table)
+        aliases[table] = table
+        if alias and alias not in _KEYWORDS:
+            aliases[alias] = table
+    return aliases
+
+
+def _resolve_column(name, aliases, tables):
+    # Columns are qualified with the table they are read from rather than the alias they
+    # are written with. An unqualified column only names its table when there is one.
+    qualifier, _, column = name.rpartition('.')
+    if qualifier:
+        return '%s.%s' % (aliases.get(qualifier, qualifier), column)
+    if len(tables) == 1:
+        return '%s.%s' % (next(iter(tables)), column)
+    return column
+
+
+def get_query_features(statement) -> Tuple[Tuple, FrozenSet[str]]:
+    """Describe the access pattern of a statement. Return the key of the bucket it must be
+    clustered in (statement type and referenced tables), and its predicate, join, group by
+    and order by features on table-qualified columns, e.g. 'p:customer.c_id:=' or
+    'j:customer.c_id=orders.o_c_id'."""
+    template = _IDENTIFIER_QUOTES.sub('', get_statement_template(statement))
+    statement_type, _ = get_statement_type(template)
+    aliases = get_table_aliases(template)
+    tables = frozenset(aliases.values())
+    features = set()
+    conditions = _SET_LIST.sub(' ', template)
+    join_key_starts = set()
+    for match in _JOIN_KEY.finditer(conditions):
+        left, right = match.groups()
+        if left not in _KEYWORDS and right not in _KEYWORDS:
+            key = sorted((_resolve_column(left, aliases, tables), _resolve_column(right, aliases, tables)))
+            features.add('j:%s=%s' % tuple(key))
+            join_key_starts.add(match.start())
+    for match in _PREDICATE.finditer(conditions):
+        column, operator = match.groups()
+        # The left column of a join key is not a predicate of its own.
+        if column not in _KEYWORDS and match.start() not in join_key_starts:
+            features.add('p:%s:%s' % (_resolve_column(column, aliases, tables), ' '.join(operator.split())))
+    for clause, columns in _CLAUSE.findall(template):
+        for column in columns.split(','):
+            column = column.strip().split(' ')[0]
+            if column:
+                features.add('%s:%s' % (clause[0], _resolve_column(column, aliases, tables)))
+    return (statement_type, tables), frozenset(features)
+
+
+def _similarity(features1: FrozenSet[str], features2: FrozenSet[str]):
+    if not features1 and not features2:
+        return 1.0
+    return len(features1 & features2) / len(features1 | features2)
+
+
+@dataclass
+class QueryCluster:
+    representative: QueryItem
+    features: FrozenSet[str]
+    members: List[QueryItem]
+
+    def get_frequency(self):
+        return sum(query.get_frequency() for query in self.members)
+
+
+class CompressedWorkload:
+    """Queries grouped in clusters of similar access patterns, each standing for its members."""
+
+    def __init__(self, clusters: List[QueryCluster]):
+        self.clusters = clusters
+        self.__representatives = {id(query): cluster.representative
+                                  for cluster in clusters for query in cluster.members}
+
+    def get_query_items(self) -> List[QueryItem]:
+        """One QueryItem per cluster, weighted by the total frequency of its members, to build a WorkLoad with."""
+        return [QueryItem(cluster.representative.get_statement(), cluster.get_frequency())
+                for cluster in self.clusters]
+
+    def get_representative(self, query: QueryItem) -> QueryItem:
+        return self.__representatives[id(query)]
+
+    def get_queries(self) -> List[QueryItem]:
+        return [query for cluster in self.clusters for query in cluster.members]
+
+
+def compress_workload(queries: Sequence[QueryItem], similarity=DEFAULT_SIMILARITY) -> CompressedWorkload:
+    """Cluster queries on the same tables whose features are at least `similarity` alike
+    (Jaccard index). A query joins the most similar cluster, found through an inverted
+    index of cluster features, or opens a new one. The most frequent member of each
+    cluster is its representative."""
+    buckets: Dict[Tuple, List[QueryCluster]] = defaultdict(list)
+    # Bucket key to the clusters holding each feature, and to the cluster of each exact feature set.
+    feature_clusters: Dict[Tuple, Dict[str, List[int]]] = defaultdict(lambda: defaultdict(list))
+    exact_clusters: Dict[Tuple, Dict[FrozenSet[str], int]] = defaultdict(dict)
+    for query in queries:
+        key, features = get_query_features(query.get_statement())
+        clusters = buckets[key]
+        best = exact_clusters[key].get(features)
+        if best is None:
+            best_similarity = similarity
+            candidates = set(position for feature in features for position in feature_clusters[key][feature])
+            if not features and clusters:
+                candidates.update(range(len(clusters)))
+            for position in sorted(candidates):
+                candidate_similarity = _similarity(features, clusters[position].features)
+                if candidate_similarity >= best_similarity:
+                    best, best_similarity = position, candidate_similarity
+                    if best_similarity == 1:
+                        break
+        if best is None:
+            best = len(clusters)
+            clusters.append(QueryCluster(query, features, []))
+            exact_clusters[key][features] = best
+            for feature in features:
+                feature_clusters[key][feature].append(best)
+        cluster = clusters[best]
+        cluster.members.append(query)
+        if query.get_frequency() > cluster.representative.get_frequency():
+            cluster.representative = query
+    return CompressedWorkload([cluster for clusters in buckets.values() for cluster in clusters])
+
+
+@dataclass
+class CompressionReport:
+    clusters: int
+    queries: int
+    sampled_queries: int
+    # Relative error of the frequency-weighted total cost of the sampled queries.
+    total_error: float
+    mean_error: float
+    max_error: float
+
+
+def estimate_compression_error(compressed: CompressedWorkload,
+                               get_costs: Callable[[List[QueryItem]], Sequence[float]],
+                               sample_size=DEFAULT_SAMPLE_SIZE, seed=0) -> CompressionReport:
+    """Compare the cost of sampled queries with the cost of their representatives.
+    `get_costs` costs a list of queries, e.g. `lambda queries: get_origin_costs(executor, queries)`."""
+    queries = compressed.get_queries()
+    sample = random.Random(seed).sample(queries, min(sample_size, len(queries)))
+    representatives = [compressed.get_representative(query) for query in sample]
+    unique_representatives = list({id(query): query for query in representatives}.values())
+    costs = get_costs(sample + unique_representatives)
+    representative_costs = dict(zip((id(query) for query in unique_representatives), costs[len(sample):]))
+    total_cost = estimated_total_cost = 0
+    errors = []
+    for query, representative, cost in zip(sample, representatives, costs):
+        estimated_cost = representative_costs[id(representative)]
+        total_cost += cost * query.get_frequency()
+        estimated_total_cost += estimated_cost * query.get_frequency()
+        errors.append(abs(estimated_cost - cost) / cost if cost else float(estimated_cost != 0))
+    return CompressionReport(len(compressed.clusters), len(queries), len(sample),
+                             abs(estimated_total_cost - total_cost) / total_cost if total_cost else 0,
+                             sum(errors) / len(errors) if errors else 0,
+                             max(errors, default=0))
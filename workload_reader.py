@@ -0,0 +1,182 @@
+import hashlib
+import re
+from typing import Iterable, Iterator, List
+
+try:
+    from .utils import QueryItem, get_statement_count, get_statement_template
+except ImportError:
+    from utils import QueryItem, get_statement_count, get_statement_template
+
+# Upper bound on the characters pulled from the file in a single read, so a workload
+# without line breaks is still consumed in bounded pieces.
+READ_LIMIT = 1 << 20
+
+_GO_PATTERN = re.compile(r'^\s*GO(?:\s+\d+)?\s*(?:--.*)?$', re.IGNORECASE)
+_NORMAL_TOKEN = re.compile(r"--|/\*|['\"\[;]")
+_BLOCK_COMMENT_TOKEN = re.compile(r'/\*|\*/')
+# Characters that may begin a two-character token ('--', '/*', '*/', "''", ']]', '""').
+_LOOKAHEAD_CHARS = frozenset('-/*\'"]')
+
+_NORMAL = 0
+_LINE_COMMENT = 1
+_BLOCK_COMMENT = 2
+_QUOTED = 3
+
+_CLOSING_QUOTES = {"'": "'", '"': '"', '[': ']'}
+
+
+class StatementTokenizer:
+    """Incremental T-SQL statement splitter.
+
+    Feed text with `feed_line` and collect finished statements from its return value.
+    Comments are dropped, while string literals, quoted and bracketed identifiers
+    are kept verbatim so that ';' inside them does not end a statement.
+    A line holding only `GO` ends the current statement, like ';'.
+    """
+
+    def __init__(self):
+        self.__buffer = []
+        self.__state = _NORMAL
+        self.__closing_quote = ''
+        self.__comment_depth = 0
+
+    def __emit(self, statements):
+        statement = ''.join(self.__buffer).strip()
+        self.__buffer = []
+        if statement:
+            statements.append(statement)
+
+    def feed_line(self, line, at_line_start=True):
+        """Consume a piece of text and return the statements completed by it.
+        `line` must not split a two-character token across calls."""
+        statements = []
+        if at_line_start and self.__state == _NORMAL and _GO_PATTERN.match(line):
+            self.__emit(statements)
+            return statements
+
+        pos, end = 0, len(line)
+        while pos < end:
+            if self.__state == _NORMAL:
+                match = _NORMAL_TOKEN.search(line, pos)
+                if not match:
+                    self.__buffer.append(line[pos:])
+                    break
+                self.__buffer.append(line[pos:match.start()])
+                token = match.group()
+                pos = match.end()
+                if token == '--':
+                    self.__state = _LINE_COMMENT
+                elif token == '/*':
+                    # Keep a separator so 'SELECT/**/1' does not glue tokens together.
+                    self.__buffer.append(' ')
+                    self.__state = _BLOCK_COMMENT
+                    self.__comment_depth = 1
+                elif token == ';':
+                    self.__emit(statements)
+                else:
+                    self.__buffer.append(token)
+                    self.__state = _QUOTED
+                    self.__closing_quote = _CLOSING_QUOTES[token]
+            elif self.__state == _LINE_COMMENT:
+                idx = line.find('\n', pos)
+                if idx < 0:
+                    break
+                self.__buffer.append('\n')
+                self.__state = _NORMAL
+                pos = idx + 1
+            elif self.__state == _BLOCK_COMMENT:
+                match = _BLOCK_COMMENT_TOKEN.search(line, pos)
+                if not match:
+                    break
+                pos = match.end()
+                # T-SQL block comments nest.
+                self.__comment_depth += 1 if match.group() == '/*' else -1
+                if self.__comment_depth == 0:
+                    self.__state = _NORMAL
+            else:
+                idx = line.find(self.__closing_quote, pos)
+                if idx < 0:
+                    self.__buffer.append(line[pos:])
+                    break
+                if line.startswith(self.__closing_quote, idx + 1):
+                    # Doubled quote is an escaped quote character.
+                    self.__buffer.append(line[pos:idx + 2])
+                    pos = idx + 2
+                    continue
+                self.__buffer.append(line[pos:idx + 1])
+                self.__state = _NORMAL
+                pos = idx + 1
+        return statements
+
+    def close(self):
+        """Flush the trailing statement which is not terminated by ';' or GO."""
+        statements = []
+        self.__emit(statements)
+        return statements
+
+
+def iter_statements(file) -> Iterator[str]:
+    """Yield statements from an open text file as soon as each one is complete."""
+    tokenizer = StatementTokenizer()
+    pending = ''
+    at_line_start = True
+    while True:
+        chunk = file.readline(READ_LIMIT)
+        text = pending + chunk
+        if not text:
+            break
+        pending = ''
+        if chunk and not text.endswith('\n'):
+            # Hold trailing characters back until we know whether they start a two-character token.
+            split = len(text)
+            while split > 0 and text[split - 1] in _LOOKAHEAD_CHARS:
+                split -= 1
+            text, pending = text[:split], text[split:]
+        if not text:
+            continue
+        yield from tokenizer.feed_line(text, at_line_start)
+        at_line_start = text.endswith('\n')
+    yield from tokenizer.close()
+
+
+def iter_workload_statements(workload_file) -> Iterator[str]:
+    """Stream the statements of a workload file with bounded memory."""
+    with open(workload_file, 'r', errors='ignore') as file:
+        yield from iter_statements(file)
+
+
+def get_statement_fingerprint(statement):
+    return hashlib.sha1(get_statement_template(statement).encode()).hexdigest()
+
+
+class TemplateCollapser:
+    """Keep the first statement of every template as its representative QueryItem
+    and count the later statements of the same template as its frequency."""
+
+    def __init__(self):
+        self.__query_items = {}
+
+    def add(self, statement, freq=1):
+        """Return a new QueryItem if the statement opens a new template, otherwise None."""
+        fingerprint = get_statement_fingerprint(statement)
+        query_item = self.__query_items.get(fingerprint)
+        if query_item is not None:
+            query_item.add_frequency(freq)
+            return None
+        query_item = QueryItem(statement, freq)
+        self.__query_items[fingerprint] = query_item
+        return query_item
+
+    def get_query_items(self) -> List[QueryItem]:
+        return list(self.__query_items.values())
+
+    def get_statement_count(self):
+        return get_statement_count(self.get_query_items())
+
+
+def collapse_statements(statements: Iterable[str]) -> List[QueryItem]:
+    """Collapse statements to one QueryItem per template, weighted by its frequency."""
+    collapser = TemplateCollapser()
+    for statement in statements:
+        collapser.add(statement)
+    return collapser.get_query_items()
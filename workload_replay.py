@@ -0,0 +1,195 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+import pyodbc
+
+try:
+    from .utils import QueryItem, create_sql_connection_string
+    from .showplan import QueryPlan, SHOWPLAN_COLUMN, SHOWPLAN_ON_SQL, STATISTICS_XML_ON_SQL, parse_showplan
+except ImportError:
+    from utils import QueryItem, create_sql_connection_string
+    from showplan import QueryPlan, SHOWPLAN_COLUMN, SHOWPLAN_ON_SQL, STATISTICS_XML_ON_SQL, parse_showplan
+
+CANCELLED = 'cancelled'
+
+
+class ConnectionPool:
+    """A bounded pool of pyodbc connections which are opened lazily and reused."""
+
+    def __init__(self, conn_str, size, query_timeout=0, session_sqls=()):
+        self.conn_str = conn_str
+        self.size = size
+        self.query_timeout = query_timeout
+        # Session settings applied once to every new connection.
+        self.session_sqls = list(session_sqls)
+        self.__idle = queue.LifoQueue()
+        self.__slots = threading.BoundedSemaphore(size)
+
+    @classmethod
+    def from_params(cls, server, database, auth_type='windows', username='', password='', size=4,
+                    query_timeout=0):
+        conn_str = create_sql_connection_string(server, database, auth_type, username, password)
+        return cls(conn_str, size, query_timeout)
+
+    def __connect(self):
+        conn = pyodbc.connect(self.conn_str, autocommit=True)
+        # Applies to every statement executed on this connection, in seconds (0 means no limit).
+        conn.timeout = self.query_timeout
+        for sql in self.session_sqls:
+            conn.execute(sql)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection. It is discarded instead of returned if the caller fails,
+        because a timed-out or cancelled statement may leave it in an unknown state."""
+        with self.__slots:
+            try:
+                conn = self.__idle.get_nowait()
+            except queue.Empty:
+                conn = self.__connect()
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            self.__idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self.__idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+@dataclass
+class ReplayResult:
+    position: int
+    query: QueryItem
+    elapsed: float
+    error: Optional[str] = None
+    # Only set when replaying estimated or actual plans.
+    plan: Optional[QueryPlan] = None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+class WorkloadReplayer:
+    """Replay workload queries concurrently over a connection pool.
+
+    At most `max_in_flight` queries are submitted but not yet reported, which bounds
+    both the load put on the server and the part of the workload held in memory.
+    Results are reported in submission order whatever order they complete in.
+
+    With `showplan` the queries are only compiled under SHOWPLAN_XML: no data is read,
+    and each result carries the estimated cost and missing indexes of its plan.
+    With `actual_plans` the queries are executed and each result carries those of the
+    actual plan returned under STATISTICS XML.
+    """
+
+    def __init__(self, conn_str, workers=4, max_in_flight=None, query_timeout=0, showplan=False,
+                 actual_plans=False):
+        self.workers = max(1, workers)
+        self.max_in_flight = max(self.workers, max_in_flight or 2 * self.workers)
+        self.showplan = showplan
+        self.actual_plans = actual_plans and not showplan
+        session_sqls = [SHOWPLAN_ON_SQL] if showplan else [STATISTICS_XML_ON_SQL] if self.actual_plans else []
+        self.pool = ConnectionPool(conn_str, self.workers, query_timeout, session_sqls=session_sqls)
+        self.__cancelled = threading.Event()
+        self.__running_cursors = set()
+        self.__lock = threading.Lock()
+
+    def cancel(self):
+        """Stop submitting queries and ask the server to abort the running ones."""
+        self.__cancelled.set()
+        with self.__lock:
+            cursors = list(self.__running_cursors)
+        for cursor in cursors:
+            try:
+                cursor.cancel()
+            except pyodbc.Error:
+                pass
+
+    def is_cancelled(self):
+        return self.__cancelled.is_set()
+
+    def __run(self, cursor, query: QueryItem):
+        cursor.execute(query.get_statement())
+        if self.actual_plans:
+            # The plan of each statement follows its own result sets.
+            plan = QueryPlan()
+            while True:
+                if cursor.description and cursor.description[0][0] == SHOWPLAN_COLUMN:
+                    for row in cursor.fetchall():
+                        parse_showplan(row[0], plan)
+                if not cursor.nextset():
+                    break
+            return plan
+        if not self.showplan:
+            # Consume the results to ensure query completes fully
+            while cursor.nextset():
+                pass
+            return None
+        # One result set holding the plan XML for every statement of the batch.
+        plan = QueryPlan()
+        while True:
+            for row in cursor.fetchall():
+                parse_showplan(row[0], plan)
+            if not cursor.nextset():
+                break
+        return plan
+
+    def __execute(self, position, query: QueryItem) -> ReplayResult:
+        if self.is_cancelled():
+            return ReplayResult(position, query, 0, CANCELLED)
+        start = time.perf_counter()
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                with self.__lock:
+                    self.__running_cursors.add(cursor)
+                try:
+                    plan = self.__run(cursor, query)
+                finally:
+                    with self.__lock:
+                        self.__running_cursors.discard(cursor)
+                    cursor.close()
+        except pyodbc.Error as e:
+            error = CANCELLED if self.is_cancelled() else str(e)
+            return ReplayResult(position, query, time.perf_counter() - start, error)
+        return ReplayResult(position, query, time.perf_counter() - start, plan=plan)
+
+    def replay(self, queries: Iterable[QueryItem]) -> Iterator[ReplayResult]:
+        """Execute the queries and yield their results in order. Closing the generator
+        early cancels the queries still in flight."""
+        pending = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                try:
+                    for position, query in enumerate(queries):
+                        if self.is_cancelled():
+                            break
+                        while len(pending) >= self.max_in_flight:
+                            yield pending.popleft().result()
+                        pending.append(executor.submit(self.__execute, position, query))
+                        while pending and pending[0].done():
+                            yield pending.popleft().result()
+                    while pending:
+                        yield pending.popleft().result()
+                except BaseException:
+                    # Cancel before the executor waits for its workers on exit.
+                    self.cancel()
+                    for future in pending:
+                        future.cancel()
+                    raise
+        finally:
+            self.pool.close()